@@ -0,0 +1,74 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+compares fetching an external include with get_external_resource,
+which opens a connection for every fetch, with fetching it through
+a ConnectionPool, which keeps the connection open between fetches.
+the includes come from a local http server standing in for an
+upstream host.  the server can be made to spend some time on each
+new connection, as a remote host would on the tcp and tls
+handshakes.
+
+usage: python benchmarks/bench_connpool.py
+"""
+
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from threading import Thread
+from wsgifilter.resource_fetcher import get_external_resource
+from transcluder.connpool import ConnectionPool
+
+BODY = '<html><body>%s</body></html>' % ('<p>fragment text</p>' * 50)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one write, as a real server would
+    wbufsize = -1
+    # seconds spent setting up each connection
+    setup_time = 0
+
+    def setup(self):
+        time.sleep(self.setup_time)
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def measure(fetch, url, count):
+    start = time.time()
+    for i in range(count):
+        status, headers, body = fetch(url, {'HTTP_ACCEPT' : 'text/html'})
+        assert status.startswith('200') and body == BODY
+    return (time.time() - start) / count
+
+if __name__ == '__main__':
+    server = ThreadingServer(('127.0.0.1', 0), Handler)
+    thread = Thread(target=server.serve_forever)
+    thread.setDaemon(1)
+    thread.start()
+    url = 'http://127.0.0.1:%d/fragment.html' % server.server_address[1]
+
+    print "%12s %20s %15s" % ('setup (ms)', 'new connection (ms)', 'pooled (ms)')
+    for setup_time, count in ((0, 1000), (0.002, 300), (0.010, 100)):
+        Handler.setup_time = setup_time
+        pool = ConnectionPool()
+        print "%12.1f %20.3f %15.3f" % (
+            setup_time * 1000,
+            measure(get_external_resource, url, count) * 1000,
+            measure(pool.get_resource, url, count) * 1000)
+        pool.close()
+    server.shutdown()
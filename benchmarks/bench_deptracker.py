@@ -0,0 +1,70 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+measures how many page requests a dependency tracker serves per
+second as the number of threads using it grows.  each request
+looks up the dependencies of a page as a conditional request
+would, then records the dependencies of every page it includes
+as the fetches of those pages complete.  one request in a
+hundred finds a page changed.
+
+usage: python benchmarks/bench_deptracker.py
+"""
+
+import random
+import time
+from threading import Thread
+from transcluder.deptracker import DependencyTracker, ShardedDependencyTracker
+
+PAGES = 200
+FANOUT = 3
+DEPTH = 3
+
+def page_deps(page, version=0):
+    if page.count('/') > DEPTH:
+        return []
+    return ['%s/%d' % (page, i) for i in range(FANOUT + version % 2)]
+
+def request(tracker, page, change):
+    key_for = lambda url: (url, '')
+    root = (page, '')
+    if tracker.is_tracked(root):
+        deps = tracker.get_all_deps(root, key_for)
+    else:
+        deps = []
+    tracker.set_direct_deps(root, page_deps(page, change))
+    for dep in deps:
+        tracker.set_direct_deps(key_for(dep), page_deps(dep))
+
+def measure(tracker, thread_count, duration=2.0):
+    counts = [0] * thread_count
+    stop = []
+    def run(index):
+        rand = random.Random(index)
+        while not stop:
+            page = 'http://localhost/page%d' % rand.randrange(PAGES)
+            request(tracker, page, rand.randrange(100) == 0)
+            counts[index] += 1
+
+    for i in range(PAGES):
+        request(tracker, 'http://localhost/page%d' % i, 0)
+    threads = [Thread(target=run, args=(i,)) for i in range(thread_count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.append(True)
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.time() - start)
+
+if __name__ == '__main__':
+    print "%8s %22s %22s" % ('threads', 'one lock (req/s)', 'sharded (req/s)')
+    for thread_count in (1, 2, 4, 8, 16, 32):
+        print "%8d %22.0f %22.0f" % (
+            thread_count,
+            measure(DependencyTracker(), thread_count),
+            measure(ShardedDependencyTracker(), thread_count))
@@ -0,0 +1,61 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+compares lxmlutils.fixup_links, which rewrites every link in one
+walk of the tree and remembers joined urls, with the three xpath
+queries it replaced, on link heavy fragments.  the remembered urls
+are shared between runs as they are between the fragments of one
+request.
+
+usage: python benchmarks/bench_fixup.py
+"""
+
+import time
+import urlparse
+from lxml import etree
+from transcluder import lxmlutils
+
+def xpath_fixup_links(doc, uri):
+    base_uri = uri
+    basetags = doc.xpath('//base[@href]')
+    if basetags:
+        base_uri = basetags[0].attrib['href']
+        for b in basetags:
+            b.getparent().remove(b)
+
+    for attr in ('href', 'src', 'action'):
+        for el in doc.xpath('//*[@%s]' % attr):
+            el.attrib[attr] = urlparse.urljoin(base_uri, el.attrib[attr])
+    return doc
+
+def make_fragment(links):
+    items = []
+    for i in range(links):
+        if i % 4 == 0:
+            items.append('<li><a href="http://example.com/abs/%d.html">abs</a></li>' % (i % 50))
+        elif i % 4 == 1:
+            items.append('<li><img src="../img/%d.png"> text</li>' % (i % 50))
+        else:
+            items.append('<li><a href="page%d.html">rel</a></li>' % (i % 50))
+    return '<html><body><form action="search"><ul>%s</ul></form></body></html>' % ''.join(items)
+
+def measure(fixup, html, count):
+    docs = [etree.HTML(html) for i in range(count)]
+    start = time.time()
+    for doc in docs:
+        fixup(doc)
+    return (time.time() - start) / count
+
+if __name__ == '__main__':
+    url = 'http://localhost/section/sub.html'
+    print "%8s %15s %15s" % ('links', 'xpath (ms)', 'one walk (ms)')
+    for links, count in ((100, 200), (1000, 50), (10000, 5)):
+        html = make_fragment(links)
+        joined = {}
+        print "%8d %15.3f %15.3f" % (
+            links,
+            measure(lambda doc: xpath_fixup_links(doc, url), html, count) * 1000,
+            measure(lambda doc: lxmlutils.fixup_links(doc, url, joined), html, count) * 1000)
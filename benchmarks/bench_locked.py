@@ -0,0 +1,96 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+measures the time @locked adds to each call of a method, with a
+Lock and with an RLock, against the decorator package based
+version it replaced (if the decorator package is installed).
+'nested' is the old PageManager.have_page_content, which took
+the RLock again through its condition inside a locked method.
+
+usage: python benchmarks/bench_locked.py
+"""
+
+import time
+from threading import Lock, RLock, Condition
+from transcluder.locked import locked
+
+try:
+    from decorator import decorator
+except ImportError:
+    decorator = None
+
+if decorator is not None:
+    @decorator
+    def decorator_locked(func, *args, **kw):
+        lock = args[0]._lock
+        lock.acquire()
+        try:
+            result = func(*args, **kw)
+        finally:
+            lock.release()
+        return result
+
+class Plain:
+    def __init__(self, lock):
+        self._lock = lock
+        self.cv = Condition(lock)
+        self._archive = {'a' : 1}
+
+    def have(self, url):
+        return url in self._archive
+
+class Locked(Plain):
+    @locked
+    def have(self, url):
+        return url in self._archive
+
+if decorator is not None:
+    class DecoratorLocked(Plain):
+        @decorator_locked
+        def have(self, url):
+            return url in self._archive
+
+    class Nested(Plain):
+        @decorator_locked
+        def have(self, url):
+            self.cv.acquire()
+            try:
+                return url in self._archive
+            finally:
+                self.cv.release()
+
+def measure(obj, count=100000, repeat=5):
+    """
+    returns the shortest time a call took over several runs
+    """
+    have = obj.have
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(count):
+            have('a')
+        took = (time.time() - start) / count
+        if best is None or took < best:
+            best = took
+    return best
+
+if __name__ == '__main__':
+    print "per call overhead over an unlocked method (ns)"
+    print "%6s %12s %12s %12s" % ('lock', 'decorator', 'nested', 'locked')
+    for name, make_lock in (('Lock', Lock), ('RLock', RLock)):
+        base = measure(Plain(make_lock()))
+        if decorator is not None:
+            old = measure(DecoratorLocked(make_lock())) - base
+            old = "%12.0f" % (old * 1e9)
+            if make_lock is RLock:
+                old += " %12.0f" % ((measure(Nested(make_lock())) - base) * 1e9)
+            else:
+                # a Lock cannot be taken twice by one thread 
+                old += " %12s" % 'n/a'
+        else:
+            old = "%12s %12s" % ('n/a', 'n/a')
+        new = measure(Locked(make_lock())) - base
+        print "%6s %s %12.0f" % (name, old, new * 1e9)
@@ -0,0 +1,61 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+measures transcluding and serializing a page which includes the
+same fragment and the same whole page 50 times each, with included
+content copied into the document for every link and with it spliced
+in by placeholder.  each mode runs in a fresh process so that the
+growth of its maximum resident size can be reported.
+
+usage: python benchmarks/bench_merge.py
+"""
+
+import resource
+import subprocess
+import sys
+import time
+from lxml import etree
+from transcluder import lxmlutils
+from transcluder.transclude import Transcluder
+
+INCLUDES = 50
+
+def make_pages():
+    links = []
+    for i in range(INCLUDES):
+        links.append('<p><a rel="include" href="http://localhost/sub.html#part">x</a></p>')
+        links.append('<p><a rel="include" href="http://localhost/sub.html">x</a></p>')
+    index = '<html><body>%s</body></html>' % ''.join(links)
+
+    rows = ''.join(['<tr><td>row %d</td><td><a href="item%d.html">item</a></td></tr>' % (i, i)
+                    for i in range(200)])
+    sub = ('<html><body><div id="part"><table>%s</table></div>'
+           '<p>and some more text</p></body></html>' % rows)
+    return index, {'http://localhost/sub.html': sub}
+
+def run(splice, count=20):
+    index, pages = make_pages()
+    fetch = lambda url: etree.HTML(pages[url])
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    for i in range(count):
+        tc = Transcluder({}, fetch, splice=splice)
+        document = etree.HTML(index)
+        tc.transclude(document, 'http://localhost/index.html')
+        html = tc.expand_placeholders(lxmlutils.tostring(document))
+    elapsed = (time.time() - start) / count
+    grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    print "%8s %15.2f %20d %15d" % (splice and 'splice' or 'copy', elapsed * 1000, grown, len(html))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(sys.argv[1] == 'splice')
+    else:
+        print "%d repeated fragment includes and %d repeated page includes" % (INCLUDES, INCLUDES)
+        print "%8s %15s %20s %15s" % ('mode', 'ms / page', 'max rss growth (kB)', 'output bytes')
+        for mode in ('copy', 'splice'):
+            sys.stdout.flush()
+            subprocess.call([sys.executable, __file__, mode])
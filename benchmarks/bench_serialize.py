@@ -0,0 +1,60 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+compares lxmlutils.tostring, which uses lxml's html serializer
+directly, with the xslt identity transform it replaced, for
+documents of about 10KB, 100KB and 1MB.  both produce utf-8
+bytes with a doctype, as the middleware needs.
+
+usage: python benchmarks/bench_serialize.py
+"""
+
+import time
+from lxml import etree
+from transcluder import lxmlutils
+
+html_transform = etree.XSLT(etree.XML("""
+<xsl:transform xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:output method="html" encoding="UTF-8" /> 
+  <xsl:template match="/">
+    <xsl:copy-of select="."/>
+  </xsl:template>
+</xsl:transform>
+"""))
+
+DOCTYPE_PAIR = ("-//W3C//DTD HTML 4.01 Transitional//EN",
+                "http://www.w3.org/TR/html4/loose.dtd")
+
+def xslt_tostring(doc, doctype_pair):
+    doc = str(html_transform(doc))
+    return """<!DOCTYPE html PUBLIC "%s" "%s">\n%s""" % (doctype_pair[0], doctype_pair[1], doc)
+
+def make_document(size):
+    row = (u'<tr><td class="n">%d</td><td><a href="/item/%d">caf\xe9 &amp; item</a></td>'
+           u'<td>some text which takes up a little room</td></tr>')
+    rows = []
+    length = 0
+    i = 0
+    while length < size:
+        rows.append(row % (i, i))
+        length += len(rows[-1])
+        i += 1
+    return etree.HTML(u'<html><head><title>t</title></head><body><table>%s</table></body></html>' 
+                      % u''.join(rows))
+
+def measure(serialize, doc, count):
+    start = time.time()
+    for i in range(count):
+        serialize(doc, DOCTYPE_PAIR)
+    return (time.time() - start) / count
+
+if __name__ == '__main__':
+    print "%10s %15s %15s" % ('size', 'xslt (ms)', 'direct (ms)')
+    for size, count in ((10*1024, 500), (100*1024, 50), (1024*1024, 5)):
+        doc = make_document(size)
+        print "%10d %15.3f %15.3f" % (size,
+                                      measure(xslt_tostring, doc, count) * 1000,
+                                      measure(lxmlutils.tostring, doc, count) * 1000)
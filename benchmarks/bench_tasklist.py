@@ -0,0 +1,54 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+measures how long a task waits between being pushed onto a
+FetchList and being picked up by a worker thread, as the number
+of concurrent page requests (registered fetch lists) grows.
+
+usage: python benchmarks/bench_tasklist.py
+"""
+
+import time
+from threading import Event
+from transcluder.tasklist import TaskList, FetchList, RequestType
+from transcluder.threadpool import WorkRequest
+
+class Probe(WorkRequest):
+    def __init__(self, url):
+        self.url = url
+        self.request_type = RequestType.get
+        self.done = Event()
+        WorkRequest.__init__(self, self)
+
+    def __call__(self):
+        self.started = time.time()
+        self.done.set()
+
+def measure(page_count, samples=200):
+    tasklist = TaskList(poolsize=4)
+    fetchlists = []
+    for i in range(page_count):
+        fetchlist = FetchList(tasklist)
+        tasklist.put_list(fetchlist)
+        fetchlists.append(fetchlist)
+
+    total = 0.0
+    for i in range(samples):
+        fetchlist = fetchlists[i % page_count]
+        probe = Probe('http://localhost/%s' % i)
+        pushed = time.time()
+        fetchlist.push(probe)
+        probe.done.wait()
+        total += probe.started - pushed
+        fetchlist.completed(probe)
+
+    tasklist.kill()
+    return total / samples
+
+if __name__ == '__main__':
+    print "%12s %20s" % ('page requests', 'dispatch latency (us)')
+    for page_count in (1, 10, 100, 500, 1000, 2000):
+        print "%12d %20.1f" % (page_count, measure(page_count) * 1000000)
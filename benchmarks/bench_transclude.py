@@ -0,0 +1,59 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+measures the throughput of Transcluder.transclude on a document
+with hundreds of include links, from one thread and from several
+threads transcluding at once as the middleware's request threads do.
+
+usage: python benchmarks/bench_transclude.py
+"""
+
+import time
+from threading import Thread
+from lxml import etree
+from transcluder.transclude import Transcluder
+
+LINKS = 300
+SUBDOCS = 20
+
+def make_pages():
+    links = []
+    for i in range(LINKS):
+        if i % 2:
+            href = 'http://localhost/sub%d.html#part' % (i % SUBDOCS)
+        else:
+            href = 'http://localhost/sub%d.html' % (i % SUBDOCS)
+        links.append('<p><a rel="include" href="%s">link %d</a></p>' % (href, i))
+    index = '<html><body>%s</body></html>' % ''.join(links)
+
+    pages = {}
+    for i in range(SUBDOCS):
+        pages['http://localhost/sub%d.html' % i] = (
+            '<html><body><p>before</p><div id="part">part %d</div>'
+            '<p>after <a href="other.html">other</a></p></body></html>' % i)
+    return index, pages
+
+def run(count):
+    index, pages = make_pages()
+    fetch = lambda url: etree.HTML(pages[url])
+    for i in range(count):
+        tc = Transcluder({}, fetch)
+        tc.transclude(etree.HTML(index), 'http://localhost/index.html')
+
+def measure(threads, count=20):
+    workers = [Thread(target=run, args=(count,)) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (threads * count) / (time.time() - start)
+
+if __name__ == '__main__':
+    print "%d include links, %d distinct subdocuments" % (LINKS, SUBDOCS)
+    print "%8s %20s" % ('threads', 'documents / second')
+    for threads in (1, 2, 4, 8):
+        print "%8d %20.1f" % (threads, measure(threads))
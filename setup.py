@@ -29,15 +29,10 @@ setup(name="Transcluder",
         'PasteScript',
         'FormEncode', 
         'WSGIFilter', 
-        "decorator",
 	"enum",
-        'pyavl',
 	'nose',
         'ElementTree'
       ],
-      dependency_links=[
-      	'http://sourceforge.net/projects/pyavl/files/pyavl/1.12/pyavl-1.12.tar.gz/download#egg=pyavl-dev'
-      ],
       include_package_data=True,
       entry_points="""
       [paste.filter_factory]
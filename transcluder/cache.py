@@ -0,0 +1,188 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+caches shared between requests
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from paste.response import header_value
+from wsgifilter.cache_utils import parse_cache_directives
+from transcluder.locked import locked
+
+
+class LRUCache:
+    """
+    a thread safe least-recently-used cache bounded
+    by the total size of the values it holds. the
+    size of each value is given by the caller when
+    it is stored.  the page manager counts only the
+    bytes of each page body, not the parsed tree kept
+    with it, which usually takes several times as
+    much memory, so max_bytes bounds the bodies alone.
+
+    hits, misses and evictions count the lookups
+    which found a value, the lookups which did not
+    and the values dropped to make room for others.
+
+    >>> cache = LRUCache(10)
+    >>> cache.put('a', 'apple', 5)
+    >>> cache.put('b', 'banana', 6)
+    >>> cache.get('a') is None
+    True
+    >>> cache.get('b')
+    'banana'
+    >>> (cache.hits, cache.misses, cache.evictions, cache.size)
+    (1, 1, 1, 6)
+    """
+
+    def __init__(self, max_bytes=10*1024*1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @locked
+    def get(self, key):
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        size, value = self._entries.pop(key)
+        self._entries[key] = (size, value)
+        return value
+
+    @locked
+    def put(self, key, value, size):
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[0]
+
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = (size, value)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            old_key, (old_size, old_value) = self._entries.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+
+    @locked
+    def remove(self, key):
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[0]
+
+    @locked
+    def __len__(self):
+        return len(self._entries)
+
+    @locked
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+def is_cacheable(status, headers, environ=None):
+    """
+    true iff the response given can be stored in a
+    cache shared between requests and revalidated
+    later, ie it was successful, carries a validator,
+    sets no cookies, is not private to one user and
+    does not forbid storage.  environ, if given, is
+    the request the response answered; a response to
+    a request made with credentials is never shared.
+    """
+    if environ is not None and 'HTTP_AUTHORIZATION' in environ:
+        return False
+
+    if not status.startswith('200'):
+        return False
+
+    if (header_value(headers, 'etag') is None and
+        header_value(headers, 'last-modified') is None):
+        return False
+
+    if header_value(headers, 'set-cookie') is not None:
+        return False
+
+    cache_control = parse_cache_directives(header_value(headers, 'cache-control'))
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return False
+
+    return True
+
+def add_validators(environ, headers):
+    """
+    make the request described by environ conditional
+    on the validators found in the response headers given
+    """
+    etag = header_value(headers, 'etag')
+    if etag is not None:
+        environ['HTTP_IF_NONE_MATCH'] = etag
+
+    last_modified = header_value(headers, 'last-modified')
+    if last_modified is not None:
+        environ['HTTP_IF_MODIFIED_SINCE'] = last_modified
+
+
+class StalePolicy:
+    """
+    decides how long a response kept in the page cache may be
+    used without being revalidated, and for how long after that
+    a stale copy may still be used: while the page is refetched
+    in the background (stale-while-revalidate), or in place of
+    an error (stale-if-error), as described by RFC 5861.  the
+    defaults given apply to responses whose Cache-Control header
+    does not say.
+
+    >>> policy = StalePolicy(stale_while_revalidate=10)
+    >>> policy.lifetimes([('Cache-Control', 'max-age=60, stale-if-error=600')])
+    (60, 10, 600)
+    >>> policy.lifetimes([('Cache-Control', 's-maxage=5, max-age=60')])
+    (5, 10, 0)
+    >>> policy.lifetimes([('Cache-Control', 'max-age=60, must-revalidate')])
+    (60, 0, 0)
+    >>> policy.lifetimes([])
+    (0, 10, 0)
+    """
+
+    def __init__(self, stale_while_revalidate=0, stale_if_error=0):
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+
+    def lifetimes(self, headers):
+        """
+        returns the number of seconds the response with the
+        headers given is fresh for, and the numbers of seconds
+        after that it may be used while it is revalidated and if
+        it cannot be
+        """
+        cache_control = parse_cache_directives(header_value(headers, 'cache-control'))
+        if 'no-cache' in cache_control:
+            return 0, 0, 0
+
+        fresh = _seconds(cache_control.get('s-maxage'),
+                         _seconds(cache_control.get('max-age'), 0))
+        if ('must-revalidate' in cache_control or
+            'proxy-revalidate' in cache_control):
+            return fresh, 0, 0
+
+        return (fresh,
+                _seconds(cache_control.get('stale-while-revalidate'),
+                         self.stale_while_revalidate),
+                _seconds(cache_control.get('stale-if-error'),
+                         self.stale_if_error))
+
+def _seconds(value, default):
+    try:
+        return int(value.strip('"'))
+    except (AttributeError, ValueError):
+        return default
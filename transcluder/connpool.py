@@ -0,0 +1,244 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+keeps http connections to the hosts external resources are
+fetched from open between fetches, so that a fetch does not
+pay for setting up a connection each time.
+"""
+
+import httplib
+import socket
+import time
+import urlparse
+from threading import Lock, Condition
+from urllib import quote
+
+from paste.proxy import parse_headers
+from wsgifilter.resource_fetcher import prep_environ
+from transcluder.locked import locked
+
+
+# headers of the incoming request which apply only to its own
+# connection
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'proxy-connection',
+                      'te', 'trailers', 'upgrade')
+
+def request_parts(url, environ):
+    """
+    returns the scheme, host, port, path and headers of a GET
+    request for the url given.  the request carries the HTTP_*
+    headers of environ in the same way as the TransparentProxy
+    used by get_external_resource.
+
+    >>> scheme, host, port, path, headers = request_parts(
+    ...     'http://example.com:8080/a b.html?x=1',
+    ...     {'HTTP_ACCEPT' : 'text/html', 'HTTP_CONNECTION' : 'close'})
+    >>> scheme, host, port, path
+    ('http', 'example.com', 8080, '/a%20b.html?x=1')
+    >>> sorted(headers.items())
+    [('accept', 'text/html'), ('host', 'example.com:8080')]
+    """
+    environ = prep_environ(url, in_environ=environ)
+    scheme, netloc = urlparse.urlsplit(url)[0:2]
+    if scheme == 'http':
+        default_port = 80
+    elif scheme == 'https':
+        default_port = 443
+    else:
+        raise ValueError("Unsupported scheme %r" % scheme)
+
+    if ':' in netloc:
+        host, port = netloc.split(':', 1)
+        port = int(port)
+    else:
+        host, port = netloc, default_port
+
+    headers = {}
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            name = key[5:].lower().replace('_', '-')
+            if name not in HOP_BY_HOP_HEADERS:
+                headers[name] = value
+    headers['host'] = environ['HTTP_HOST']
+    if 'REMOTE_ADDR' in environ and 'HTTP_X_FORWARDED_FOR' not in environ:
+        headers['x-forwarded-for'] = environ['REMOTE_ADDR']
+
+    path = quote(environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''))
+    if environ.get('QUERY_STRING'):
+        path += '?' + environ['QUERY_STRING']
+
+    return scheme, host, port, path, headers
+
+
+class ConnectionPool:
+    """
+    fetches external resources over persistent connections,
+    keeping the connections which the server leaves open for
+    the next fetch from the same host.  safe to share between
+    threads.
+
+    max_idle - the number of idle connections kept open across
+      all hosts
+
+    max_per_host - the number of connections open to a host at
+      once.  a fetch waits for one of them to be returned
+      rather than open another, until the transcluder.deadline
+      of its environ or for at most timeout seconds.
+
+    idle_timeout - the number of seconds an idle connection is
+      kept before it is closed
+
+    timeout - the socket timeout of each connection, in seconds
+
+    created and reused count the connections opened and the
+    fetches which reused an idle connection.
+    """
+
+    def __init__(self, max_idle=20, max_per_host=8, idle_timeout=30,
+                 timeout=60):
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._lock = Lock()
+        self.cv = Condition(self._lock)
+        # (scheme, host, port) -> [(connection, time it was returned)],
+        # most recently returned last
+        self._idle = {}
+        self._idle_count = 0
+        # (scheme, host, port) -> the number of connections open,
+        # whether idle or in use
+        self._open = {}
+
+        self.created = 0
+        self.reused = 0
+
+    def get_resource(self, url, environ):
+        """
+        GETs the url given, returning the (status, headers, body)
+        triple get_external_resource would return
+        """
+        scheme, host, port, path, headers = request_parts(url, environ)
+        key = (scheme, host, port)
+
+        deadline = time.time() + self.timeout
+        if environ.get('transcluder.deadline') is not None:
+            deadline = min(deadline, environ['transcluder.deadline'])
+        conn, reused = self._checkout(key, deadline)
+        try:
+            try:
+                response = self._request(conn, path, headers)
+            except (httplib.HTTPException, socket.error):
+                if not reused:
+                    raise
+                # the server may have closed the connection while it
+                # was idle, so try once more on a new one
+                conn.close()
+                conn = self._connect(key)
+                response = self._request(conn, path, headers)
+        except:
+            conn.close()
+            self._checkin(key, None)
+            raise
+
+        status, headers, body, keep_open = response
+        if keep_open:
+            self._checkin(key, conn)
+        else:
+            conn.close()
+            self._checkin(key, None)
+        return status, headers, body
+
+    def _request(self, conn, path, headers):
+        conn.request('GET', path, headers=headers)
+        res = conn.getresponse()
+        body = res.read()
+        status = '%s %s' % (res.status, res.reason)
+        return status, parse_headers(res.msg), body, not res.will_close
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn_class = httplib.HTTPSConnection
+        else:
+            conn_class = httplib.HTTPConnection
+        self.created += 1
+        return conn_class(host, port, timeout=self.timeout)
+
+    def _checkout(self, key, deadline):
+        """
+        returns an idle connection to the host given and True, or
+        a new one and False, waiting if the host already has as
+        many connections open as it may.  raises socket.timeout
+        if none is free by the deadline given.
+        """
+        self.cv.acquire()
+        try:
+            while 1:
+                idle = self._idle.get(key)
+                now = time.time()
+                while idle:
+                    conn, returned = idle.pop()
+                    self._idle_count -= 1
+                    if now - returned < self.idle_timeout:
+                        self.reused += 1
+                        return conn, True
+                    conn.close()
+                    self._open[key] -= 1
+
+                if self._open.get(key, 0) < self.max_per_host:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    return self._connect(key), False
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("no connection to %s:%s free in time"
+                                         % key[1:])
+                self.cv.wait(remaining)
+        finally:
+            self.cv.release()
+
+    @locked
+    def _checkin(self, key, conn):
+        """
+        returns a connection taken by _checkout, or None if it was
+        closed
+        """
+        if conn is not None and self._idle_count >= self.max_idle:
+            self._close_expired(time.time())
+        if conn is not None and self._idle_count < self.max_idle:
+            self._idle.setdefault(key, []).append((conn, time.time()))
+            self._idle_count += 1
+        else:
+            if conn is not None:
+                conn.close()
+            self._open[key] -= 1
+        # waiters may be waiting for other hosts
+        self.cv.notifyAll()
+
+    def _close_expired(self, now):
+        for key, idle in self._idle.items():
+            kept = []
+            for conn, returned in idle:
+                if now - returned < self.idle_timeout:
+                    kept.append((conn, returned))
+                else:
+                    conn.close()
+                    self._open[key] -= 1
+                    self._idle_count -= 1
+            self._idle[key] = kept
+
+    @locked
+    def close(self):
+        """
+        closes all idle connections
+        """
+        for key, idle in self._idle.items():
+            for conn, returned in idle:
+                conn.close()
+                self._open[key] -= 1
+        self._idle = {}
+        self._idle_count = 0
@@ -5,7 +5,11 @@
 
 
 from sets import Set
-from threading import RLock 
+from collections import OrderedDict
+from threading import Lock, RLock 
+import json
+import sqlite3
+import time
 from transcluder.locked import locked
 from transcluder.cookie_wrapper import get_relevant_cookies, make_cookie_string
 
@@ -21,27 +25,116 @@ def _merge_cookie_info(cookies):
     return ",".join(cookie_strings)
 
 
-def make_resource_key(url, environ): 
+def make_resource_key(url, environ, cookie_names=None): 
+    """
+    returns a key identifying the resource at url as seen 
+    with the cookies in environ.  if cookie_names is given, 
+    only the cookies named in it are part of the key, so 
+    that requests differing only in other cookies (eg 
+    session ids) share a key. 
+    """
     cookies = [] 
     if environ.has_key('transcluder.incookies'): 
         cookies = get_relevant_cookies(environ['transcluder.incookies'], url)
+    if cookie_names is not None: 
+        cookies = [c for c in cookies if c['name'] in cookie_names]
 
     cookies_id = _merge_cookie_info(cookies)
 
     return (url, cookies_id)
 
-class DependencyTracker: 
+class BaseDependencyTracker:
+    """
+    records the direct dependencies of resources, ie the 
+    urls of the pages each resource includes.  resources 
+    are keys produced by make_resource_key. 
+
+    subclasses store the dependencies by implementing 
+    set_direct_deps, get_direct_deps, is_tracked, clear 
+    and __len__, and provide a reentrant _lock. 
+    """
+
+    def set_direct_deps(self, resource, deps): 
+        raise NotImplementedError
+
+    def get_direct_deps(self, resource): 
+        raise NotImplementedError
+
+    def is_tracked(self, resource): 
+        raise NotImplementedError
+
+    def clear(self): 
+        raise NotImplementedError
+
+    def __len__(self): 
+        raise NotImplementedError
+
+    def update(self, dep_map): 
+        for resource, deps in dep_map.items(): 
+            self.set_direct_deps(resource, deps)
+
+    @locked
+    def get_all_deps(self, resource, key_for=None): 
+        """
+        returns the urls of the pages the resource given includes, 
+        directly or through other pages, each once and nearest 
+        first.  key_for maps the url of each page to the resource 
+        its own dependencies are kept under; by default it is the 
+        url with the cookies of the resource given. 
+        """
+        if key_for is None: 
+            key_for = _same_cookies(resource)
+        return self._find_all_deps(resource, key_for)[0]
+
+    def _find_all_deps(self, resource, key_for): 
+        """
+        returns the urls get_all_deps returns and the resources 
+        looked up to find them: the resource given followed by 
+        the resource of each url in turn 
+        """
+        deps = []
+        seen = Set()
+        resources = [resource]
+        index = 0
+        while index < len(resources): 
+            for dep in self.get_direct_deps(resources[index]): 
+                if not dep in seen: 
+                    seen.add(dep)
+                    deps.append(dep)
+                    resources.append(key_for(dep))
+            index += 1
+        return deps, resources
+
+def _same_cookies(resource): 
+    cookies_id = resource[1]
+    return lambda url: (url, cookies_id)
+
+
+class DependencyTracker(BaseDependencyTracker): 
+    """
+    an unbounded dependency tracker held in memory.  the 
+    result of get_all_deps is remembered for each resource 
+    until the dependencies of a resource looked up to find 
+    it change. 
+    """
     def __init__(self): 
         self._deps = {}
         self._lock = RLock() 
+        # resource -> (urls, resources) found by _find_all_deps 
+        self._all_deps = {}
+        # resource -> the resources whose remembered dependencies 
+        # were found by looking it up 
+        self._dependents = {}
 
     @locked
     def set_direct_deps(self, resource, deps): 
+        if self._deps.get(resource) != deps: 
+            self._forget_all_deps(resource)
         self._deps[resource] = deps[:]
 
     @locked
     def update(self, dep_map): 
-        self._deps.update(dep_map)
+        BaseDependencyTracker.update(self, dep_map)
 
     @locked
     def __len__(self): 
@@ -51,6 +144,44 @@ class DependencyTracker:
     @locked
     def clear(self): 
         self._deps.clear()
+        self._all_deps.clear()
+        self._dependents.clear()
+
+    @locked
+    def get_all_deps(self, resource, key_for=None): 
+        if key_for is None: 
+            key_for = _same_cookies(resource)
+
+        found = self._all_deps.get(resource)
+        # the resources of the pages included can depend on 
+        # cookies which the resource given does not 
+        if (found is not None and 
+            [key_for(dep) for dep in found[0]] == found[1][1:]): 
+            return found[0][:]
+
+        if found is not None: 
+            self._forget_all_deps(resource)
+        deps, resources = self._find_all_deps(resource, key_for)
+        self._all_deps[resource] = (deps, resources)
+        for looked_up in resources: 
+            self._dependents.setdefault(looked_up, Set()).add(resource)
+        return deps[:]
+
+    def _forget_all_deps(self, resource): 
+        """
+        forgets the remembered dependencies found by looking up 
+        the resource given 
+        """
+        for dependent in self._dependents.pop(resource, ()): 
+            found = self._all_deps.pop(dependent, None)
+            if found is None: 
+                continue
+            for looked_up in found[1]: 
+                dependents = self._dependents.get(looked_up)
+                if dependents is not None: 
+                    dependents.discard(dependent)
+                    if not dependents: 
+                        del self._dependents[looked_up]
 
     @locked
     def is_tracked(self, resource): 
@@ -63,24 +194,200 @@ class DependencyTracker:
         else:
             return []
 
+
+class LRUDependencyTracker(DependencyTracker): 
+    """
+    a dependency tracker held in memory which forgets the 
+    least recently used resources once it tracks more than 
+    max_entries of them 
+    """
+    def __init__(self, max_entries=10000): 
+        DependencyTracker.__init__(self)
+        self._deps = OrderedDict()
+        self.max_entries = max_entries
+        self.evictions = 0
+
+    @locked
+    def set_direct_deps(self, resource, deps): 
+        if self._deps.pop(resource, None) != deps: 
+            self._forget_all_deps(resource)
+        self._deps[resource] = deps[:]
+        while len(self._deps) > self.max_entries: 
+            evicted, deps = self._deps.popitem(last=False)
+            self._forget_all_deps(evicted)
+            self.evictions += 1
+
+    @locked
+    def update(self, dep_map): 
+        BaseDependencyTracker.update(self, dep_map)
+
+    @locked
+    def is_tracked(self, resource): 
+        return self._touch(resource) is not None
+
     @locked
-    def get_all_deps(self, resource): 
-        seen = Set() 
+    def get_direct_deps(self, resource): 
+        deps = self._touch(resource)
+        if deps is not None:
+            return deps[:]
+        else:
+            return []
+
+    def _touch(self, resource): 
+        deps = self._deps.pop(resource, None)
+        if deps is not None: 
+            self._deps[resource] = deps
+        return deps
+
+
+class ShardedDependencyTracker(BaseDependencyTracker): 
+    """
+    an unbounded dependency tracker held in memory which lets 
+    many threads use it at once.  the resources are split into 
+    shards by their hash, and recording dependencies only locks 
+    the shard of the resource.  the dependencies recorded are 
+    never changed in place but replaced, so they are looked up 
+    without taking any lock. 
+    """
+    def __init__(self, shards=16): 
+        self._shards = [{} for i in range(shards)]
+        self._locks = [Lock() for i in range(shards)]
+
+    def _shard_index(self, resource): 
+        return hash(resource) % len(self._shards)
+
+    def set_direct_deps(self, resource, deps): 
+        index = self._shard_index(resource)
+        with self._locks[index]:
+            self._shards[index][resource] = tuple(deps)
 
-        deps = self.get_direct_deps(resource)
+    def get_direct_deps(self, resource): 
+        return list(self._shards[self._shard_index(resource)].get(resource, ()))
+
+    def is_tracked(self, resource): 
+        return resource in self._shards[self._shard_index(resource)]
+
+    def clear(self): 
+        for index, shard in enumerate(self._shards): 
+            with self._locks[index]:
+                shard.clear()
 
-        index = 0 
-        while index < len(deps): 
-            new_deps = self.get_direct_deps(deps[index])
-            for dep in new_deps: 
+    def __len__(self): 
+        return sum([len(shard) for shard in self._shards])
+
+    def get_all_deps(self, resource, key_for=None): 
+        if key_for is None: 
+            key_for = _same_cookies(resource)
+        return self._find_all_deps(resource, key_for)[0]
+
+    def _find_all_deps(self, resource, key_for): 
+        shards = self._shards
+        count = len(shards)
+        deps = []
+        seen = Set()
+        resources = [resource]
+        index = 0
+        while index < len(resources): 
+            looked_up = resources[index]
+            for dep in shards[hash(looked_up) % count].get(looked_up, ()): 
                 if not dep in seen: 
                     seen.add(dep)
-                    dep_list.append(dep)
+                    deps.append(dep)
+                    resources.append(key_for(dep))
             index += 1
+        return deps, resources
 
-        return deps
 
-    
+def _db_key(resource): 
+    url, cookies_id = resource
+    return url + '\0' + cookies_id
+
+class SqliteDependencyTracker(BaseDependencyTracker): 
+    """
+    a dependency tracker kept in an sqlite database file, 
+    so that dependencies survive restarts and can be shared 
+    by several processes on one host.  if max_entries is 
+    given, the resources updated least recently are dropped 
+    once more than max_entries are tracked. 
+    """
+    def __init__(self, path, max_entries=None, timeout=30): 
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = RLock()
+        self._db = sqlite3.connect(path, timeout=timeout, 
+                                   isolation_level=None, 
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        try:
+            self._db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            pass
+        self._db.execute('CREATE TABLE IF NOT EXISTS deps ('
+                         'resource TEXT PRIMARY KEY, deps TEXT, updated REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS deps_updated ON deps (updated)')
 
+    @locked
+    def set_direct_deps(self, resource, deps): 
+        if self._set(resource, deps): 
+            self._trim()
+
+    @locked
+    def update(self, dep_map): 
+        self._db.execute('BEGIN')
+        try:
+            added = False
+            for resource, deps in dep_map.items(): 
+                if self._set(resource, deps): 
+                    added = True
+            if added: 
+                self._trim()
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _set(self, resource, deps): 
+        """
+        stores the deps of the resource given, returning whether 
+        the resource was not tracked before.  only then can the 
+        table have grown past max_entries. 
+        """
+        row = (json.dumps(list(deps)), time.time(), _db_key(resource))
+        cursor = self._db.execute('UPDATE deps SET deps = ?, updated = ? '
+                                  'WHERE resource = ?', row)
+        if cursor.rowcount > 0: 
+            return False
+        self._db.execute('INSERT OR REPLACE INTO deps (deps, updated, resource) '
+                         'VALUES (?, ?, ?)', row)
+        return True
+
+    @locked
+    def get_direct_deps(self, resource): 
+        row = self._db.execute('SELECT deps FROM deps WHERE resource = ?', 
+                               (_db_key(resource),)).fetchone()
+        if row is None: 
+            return []
+        return [url.encode('utf-8') for url in json.loads(row[0])]
+
+    @locked
+    def is_tracked(self, resource): 
+        row = self._db.execute('SELECT 1 FROM deps WHERE resource = ?', 
+                               (_db_key(resource),)).fetchone()
+        return row is not None
+
+    @locked
+    def clear(self): 
+        self._db.execute('DELETE FROM deps')
+
+    @locked
+    def __len__(self): 
+        return self._db.execute('SELECT COUNT(*) FROM deps').fetchone()[0]
 
-        
+    def _trim(self): 
+        if self.max_entries is None: 
+            return
+        excess = len(self) - self.max_entries
+        if excess > 0: 
+            self._db.execute('DELETE FROM deps WHERE rowid IN '
+                             '(SELECT rowid FROM deps ORDER BY updated LIMIT ?)', 
+                             (excess,))
@@ -0,0 +1,246 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+an event loop for fetching external resources without
+tying up a thread per request. all sockets are driven
+by asyncore from a single dedicated thread.
+"""
+
+import asyncore
+import httplib
+import os
+import socket
+import sys
+import time
+import traceback
+from StringIO import StringIO
+from threading import Lock, Thread
+
+from paste.proxy import parse_headers
+from transcluder.connpool import request_parts
+from transcluder.locked import locked
+
+
+class FetchEngine:
+    """
+    performs http GET requests on an event loop running
+    in its own thread. callers hand over a url and a wsgi
+    environ (as they would to get_external_resource) along
+    with a callback, and return immediately. the callback
+    is later called on the loop thread with the response
+    triple (status, headers, body) and None, or with None
+    and the exc_info of the failure.
+
+    timeout - the number of seconds a fetch may take before
+      it is abandoned.  a fetch is abandoned sooner if the
+      environ given has an earlier transcluder.deadline.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.alive = True
+        self._map = {}
+        self._calls = []
+        self._lock = Lock()
+        self._waker = _Waker(self._map)
+        self._thread = Thread(target=self._run)
+        self._thread.setDaemon(1)
+        self._thread.start()
+
+    def get_external_resource(self, url, environ, callback):
+        """
+        start fetching the url given. the host name is resolved
+        in the calling thread so that the loop never blocks.
+        """
+        try:
+            address, request = make_request(url, environ)
+        except:
+            callback(None, sys.exc_info())
+            return
+
+        deadline = time.time() + self.timeout
+        if environ.get('transcluder.deadline') is not None:
+            deadline = min(deadline, environ['transcluder.deadline'])
+        self._call_soon(lambda: _HTTPFetch(self._map, address, request,
+                                           callback, deadline))
+
+    def kill(self):
+        self.alive = False
+        self._waker.wake()
+
+    @locked
+    def _call_soon(self, func):
+        self._calls.append(func)
+        self._waker.wake()
+
+    @locked
+    def _take_calls(self):
+        calls = self._calls
+        self._calls = []
+        return calls
+
+    def _run(self):
+        while self.alive:
+            asyncore.loop(timeout=1, map=self._map, count=1)
+            for func in self._take_calls():
+                try:
+                    func()
+                except:
+                    traceback.print_exc(file=sys.stderr)
+
+            now = time.time()
+            for fetch in self._map.values():
+                if isinstance(fetch, _HTTPFetch) and fetch.deadline < now:
+                    fetch.handle_timeout()
+
+
+def make_request(url, environ):
+    """
+    returns the address to connect to and the request to send
+    in order to GET the url given. the request carries the
+    HTTP_* headers of environ in the same way as the
+    TransparentProxy used by get_external_resource.
+    """
+    scheme, host, port, path, headers = request_parts(url, environ)
+    if scheme != 'http':
+        raise ValueError("Unsupported scheme %r" % scheme)
+
+    family, socktype, proto, name, address = socket.getaddrinfo(
+        host, port, 0, socket.SOCK_STREAM)[0]
+
+    headers['connection'] = 'close'
+
+    request = ['GET %s HTTP/1.0' % path]
+    request += ['%s: %s' % item for item in headers.items()]
+    request = '\r\n'.join(request) + '\r\n\r\n'
+
+    return (family, address), request
+
+def parse_response(data):
+    """
+    splits a complete HTTP response into a
+    (status, headers, body) triple
+
+    >>> parse_response('HTTP/1.0 200 OK\\r\\nContent-Type: text/html\\r\\nContent-Length: 2\\r\\n\\r\\nhi')
+    ('200 OK', [('Content-Type', 'text/html'), ('Content-Length', '2')], 'hi')
+    """
+    head, sep, body = data.partition('\r\n\r\n')
+    if not sep:
+        raise httplib.IncompleteRead(data)
+
+    status, headers = parse_head(head)
+
+    length = content_length(headers)
+    if length is not None:
+        body = body[:length]
+
+    return status, headers, body
+
+def parse_head(head):
+    """
+    returns the status and headers from the status line
+    and header lines of an HTTP response
+    """
+    status_line, sep, header_lines = head.partition('\r\n')
+    version, status = status_line.split(' ', 1)
+    if not version.startswith('HTTP/'):
+        raise httplib.BadStatusLine(status_line)
+
+    headers = parse_headers(httplib.HTTPMessage(StringIO(header_lines + '\r\n\r\n')))
+    return status.strip(), headers
+
+def content_length(headers):
+    for name, value in headers:
+        if name.lower() == 'content-length':
+            return int(value)
+    return None
+
+
+class _Waker(asyncore.file_dispatcher):
+    """
+    a pipe which wakes the event loop when written to
+    """
+
+    def __init__(self, map):
+        self._reader, self._writer = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._reader, map=map)
+        os.close(self._reader)
+
+    def wake(self):
+        os.write(self._writer, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(512)
+
+
+class _HTTPFetch(asyncore.dispatcher):
+    """
+    a single non-blocking request on the event loop
+    """
+
+    def __init__(self, map, address, request, callback, deadline):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.callback = callback
+        self.deadline = deadline
+        self._out = request
+        self._in = []
+        self._finished = False
+        family, address = address
+        try:
+            self.create_socket(family, socket.SOCK_STREAM)
+            self.connect(address)
+        except:
+            self.handle_error()
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return not self.connected or len(self._out) > 0
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self._in.append(data)
+
+    def handle_close(self):
+        self.close()
+        try:
+            response = parse_response(''.join(self._in))
+        except:
+            self._finish(None, sys.exc_info())
+        else:
+            self._finish(response, None)
+
+    def handle_error(self):
+        error = sys.exc_info()
+        self.close()
+        self._finish(None, error)
+
+    def handle_timeout(self):
+        self.close()
+        try:
+            raise socket.timeout("fetch timed out")
+        except socket.timeout:
+            self._finish(None, sys.exc_info())
+
+    def _finish(self, response, error):
+        if self._finished:
+            return
+        self._finished = True
+        try:
+            self.callback(response, error)
+        except:
+            print >> sys.stderr, "Error in fetch engine callback %r:" % self.callback
+            traceback.print_exc(file=sys.stderr)
+            print >> sys.stderr, "-"*60
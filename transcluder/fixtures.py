@@ -0,0 +1,26 @@
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+"""
+fixtures shared by the tests 
+"""
+
+import os
+from wsgifilter.fixtures.cache_fixture import CacheFixtureApp, CacheFixtureResponseInfo
+
+def make_304_app():
+    """
+    returns a CacheFixtureApp serving the pages of 
+    test-data/304 with etags, and a dict of the response 
+    infos of the pages by name, which a test may change 
+    """
+    test_dir = os.path.join(os.path.dirname(__file__), 'test-data', '304')
+    cache_app = CacheFixtureApp()
+    pages = {}
+    for page in ('index.html', 'page1.html', 'page2.html'):
+        pages[page] = CacheFixtureResponseInfo(open(os.path.join(test_dir, page)).read())
+        pages[page].etag = page
+        cache_app.map_url('/' + page, pages[page])
+    return cache_app, pages
@@ -1,45 +1,44 @@
-
 # Copyright (c) 2007 The Open Planning Project.
 
 # Transcluder is Free Software.  See license.txt for licensing terms
 
 
-from decorator import decorator
-
-@decorator
-def locked(func, *args, **kw):
-    lock = args[0]._lock
-    lock.acquire()
-    try:
-        result = func(*args, **kw)
-    finally:
-        lock.release()
-    return result
+from functools import wraps
+import time
+
+def locked(func):
+    """
+    makes a method run while holding the _lock of its instance
+    """
+    @wraps(func)
+    def locked_method(self, *args, **kw):
+        with self._lock:
+            return func(self, *args, **kw)
+    return locked_method
+
+def xlocked(func):
+    """
+    like locked, but holds the cv of the instance if it has one 
+    and reports waits for the lock and calls which take more 
+    than a tenth of a second 
+    """
+    @wraps(func)
+    def locked_method(self, *args, **kw):
+        if hasattr(self, 'cv'):
+            lock = self.cv
+        else:
+            lock = self._lock
 
-@decorator
-def xlocked(func, *args, **kw):
-    if hasattr(args[0], 'cv'):
-        lock = args[0].cv
-    else:
-        lock = args[0]._lock
-
-    import time
-    start = time.time()
-    lock.acquire()
-    try:
-        bad = False
-        if time.time() - start > 0.10:
-            bad = True
-            print "waited %s on %s" % (time.time() - start, func)
-            if hasattr(lock, 'oldThread'):
-                print lock.oldThread
         start = time.time()
-        out = func(*args, **kw)
-        end = time.time()
-        if end - start > 0.1:
-            print "func %s itself took %s" % (func, end - start)
-        return out
-    finally:
-        lock.release()
-    
-
+        with lock:
+            if time.time() - start > 0.10:
+                print "waited %s on %s" % (time.time() - start, func)
+                if hasattr(lock, 'oldThread'):
+                    print lock.oldThread
+            start = time.time()
+            out = func(self, *args, **kw)
+            end = time.time()
+            if end - start > 0.1:
+                print "func %s itself took %s" % (func, end - start)
+            return out
+    return locked_method
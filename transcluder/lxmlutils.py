@@ -7,8 +7,10 @@
 # XXX these are also in deliverance
 
 from lxml import etree
+import cgi
 import urlparse
 import re
+import threading
 
 def replace_element(old_el, new_el):
     """
@@ -21,47 +23,74 @@ def replace_element(old_el, new_el):
 
 
 
-def fixup_links(doc, uri):
+# attributes which hold a single url, as in lxml.html.defs.link_attrs
+# (less archive, which holds a list)
+LINK_ATTRS = frozenset(['action', 'background', 'cite', 'classid', 'codebase', 
+                        'data', 'dynsrc', 'href', 'longdesc', 'lowsrc', 
+                        'profile', 'src', 'usemap'])
+
+_absolute_url_pat = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.\-]*):(//[^/])?')
+_css_url_pat = re.compile(r"""(url)\((\s*)(["']?)(.*?)\3(\s*)\)""", re.I)
+
+def fixup_links(doc, uri, joined=None):
     """ 
     replaces relative urls found in the document given 
     with absolute urls by prepending the uri given. 
     <base href> tags are removed from the document. 
 
-    Affects urls in href attributes, src attributes and 
-    css of the form url(...) in style elements 
+    Affects urls in the attributes listed in LINK_ATTRS and 
+    css of the form url(...) in style elements and style 
+    attributes.  
+
+    joined - an optional dictionary in which joined urls are 
+      remembered by (base uri, url), to be shared by calls 
+      fixing up documents from the same sites 
     """
+    if joined is None: 
+        joined = {}
+
     base_uri = uri
-    basetags = doc.xpath('//base[@href]')
+    basetags = [b for b in doc.iter('base') if b.get('href') is not None]
     if basetags:
         base_uri = basetags[0].attrib['href']
 
         for b in basetags:
             b.getparent().remove(b)
 
-    elts = doc.xpath('//*[@href]')
-    fixup_link_attrs(elts, base_uri, 'href')
-
-    elts = doc.xpath('//*[@src]')
-    fixup_link_attrs(elts, base_uri, 'src')
-
-    elts = doc.xpath('//*[@action]')
-    fixup_link_attrs(elts, base_uri, 'action')
-
-    #elts = doc.xpath('//head/style')
-    #fixup_css_links(elts, base_uri)
+    def join(url): 
+        key = (base_uri, url)
+        if key in joined: 
+            return joined[key]
+        match = _absolute_url_pat.match(url)
+        if match and (match.group(2) or 
+                      match.group(1).lower() not in urlparse.uses_relative): 
+            result = url
+        else: 
+            result = urlparse.urljoin(base_uri, url)
+        joined[key] = result
+        return result
+
+    def join_css(match): 
+        name, space, quote, url, endspace = match.groups()
+        return '%s(%s%s%s%s%s)' % (name, space, quote, join(url), quote, endspace)
+
+    for el in doc.iter(etree.Element): 
+        for name, value in el.items(): 
+            if name in LINK_ATTRS: 
+                new_value = join(value)
+            elif name == 'style' and 'url(' in value.lower(): 
+                new_value = _css_url_pat.sub(join_css, value)
+            else: 
+                continue
+            if new_value != value: 
+                el.set(name, new_value)
+
+        if el.tag == 'style' and el.text and 'url(' in el.text.lower(): 
+            el.text = _css_url_pat.sub(join_css, el.text)
 
     return doc
 
 
-def fixup_link_attrs(elts, base_uri, attr):
-    """
-    prepends base_uri onto the attribute given by attr for 
-    all elements given in elts 
-    """
-    for el in elts:
-        el.attrib[attr] = urlparse.urljoin(base_uri, el.attrib[attr])
-
-
 def append_text(parent, text):
     if text is None:
         return
@@ -198,31 +227,98 @@ def replace_many(old_el, new_els):
         else:
             non_text_els[0].tail = preserve_tail
 
-html_xsl = """
-<xsl:transform xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
-  <xsl:output method="html" encoding="UTF-8" /> 
-  <xsl:template match="/">
-    <xsl:copy-of select="."/>
-  </xsl:template>
-</xsl:transform>
-"""
+def inner_html(el):
+    """
+    return the UTF-8 encoded HTML serialization of the 
+    text and children of the element given, without the 
+    element itself 
+    """
+    parts = []
+    if el.text:
+        parts.append(cgi.escape(el.text).encode('utf-8'))
+    for child in el:
+        parts.append(etree.tostring(child, method='html', encoding='utf-8'))
+    return ''.join(parts)
+
+class UnparsedDocument:
+    """
+    stands in for the parsed form of an html document which is 
+    known to contain no transcluder links, so that it is only 
+    parsed if its content is needed.  it is never changed, so 
+    copies of it are itself. 
+    """
+    def __init__(self, body, encoding=None):
+        self.body = body
+        self.encoding = encoding
+
+    def parse(self):
+        """
+        returns a newly parsed tree of the document 
+        """
+        if self.encoding is not None and not isinstance(self.body, unicode):
+            return etree.HTML(self.body, etree.HTMLParser(encoding=self.encoding))
+        return etree.HTML(self.body)
 
-html_transform = etree.XSLT(etree.XML(html_xsl))
+    def __copy__(self):
+        return self
 
+    def __deepcopy__(self, memo):
+        return self
 
-def tostring(doc, doctype_pair=None):
+class _XPaths(threading.local):
     """
-    return HTML string representation of the document given 
- 
-    note: this will create a meta http-equiv="Content" tag in the head
-    and may replace any that are present 
+    compiled xpath expressions used by tostring, one set per 
+    thread as in transclude 
     """
+    def __init__(self):
+        self.content_type_metas = etree.XPath(
+            "//head/meta[translate(@http-equiv, "
+            "'CONTENTYP', 'contentyp')='content-type']")
 
-    doc = str(html_transform(doc))
+_xpaths = _XPaths()
 
+def tostring(doc, doctype_pair=None, encoding='UTF-8'):
+    """
+    return HTML string representation of the document given, 
+    encoded with the encoding given
+ 
+    note: the output carries a meta http-equiv="Content-Type" 
+    tag in the head naming the encoding, in place of any that 
+    are present.  the document itself is left unchanged. 
+    """
+    tree = doc.getroottree()
+    doctype = None
     if doctype_pair: 
-        doc = """<!DOCTYPE html PUBLIC "%s" "%s">\n%s""" % (doctype_pair[0], doctype_pair[1], doc) 
-
-    return doc
-
-                  
+        doctype = """<!DOCTYPE html PUBLIC "%s" "%s">""" % doctype_pair
+    else: 
+        # serializing the root element alone leaves out the 
+        # doctype the html parser gives every document 
+        tree = tree.getroot()
+
+    content_type = 'text/html; charset=%s' % encoding
+    metas = _xpaths.content_type_metas(doc)
+    if metas: 
+        old_contents = [meta.get('content') for meta in metas]
+        for meta in metas: 
+            meta.set('content', content_type)
+        try: 
+            return etree.tostring(tree, method='html', encoding=encoding, doctype=doctype)
+        finally: 
+            for meta, content in zip(metas, old_contents): 
+                if content is None: 
+                    del meta.attrib['content']
+                else: 
+                    meta.set('content', content)
+
+    head = doc.getroottree().getroot().find('head')
+    if head is None: 
+        return etree.tostring(tree, method='html', encoding=encoding, doctype=doctype)
+
+    meta = etree.Element('meta')
+    meta.set('http-equiv', 'Content-Type')
+    meta.set('content', content_type)
+    head.insert(0, meta)
+    try: 
+        return etree.tostring(tree, method='html', encoding=encoding, doctype=doctype)
+    finally: 
+        head.remove(meta)
@@ -9,9 +9,13 @@ Transclusion WSGI middleware
 """
 import httplib
 import re
+import sys
+import time
+from threading import Lock
 
 from paste.request import construct_url
 from paste.response import header_value, replace_header
+from paste.httpheaders import EXPIRES
 from paste.wsgilib import intercept_output
 from urlparse import urlparse
 from lxml import etree
@@ -20,27 +24,147 @@ import lxmlutils
 from transcluder import helpers 
 from transcluder.transclude import Transcluder
 
-from wsgifilter.resource_fetcher import get_internal_resource, get_external_resource, get_file_resource, Request
-from wsgifilter.cache_utils import parse_merged_etag
+from wsgifilter.resource_fetcher import get_internal_resource, get_external_resource, get_file_resource, Request, prep_environ
+from wsgifilter.cache_utils import parse_merged_etag, parse_cache_directives
 from transcluder.cookie_wrapper import * 
-from transcluder.tasklist import PageManager, TaskList
-from transcluder.deptracker import DependencyTracker
+from transcluder.tasklist import PageManager, TaskList, SingleFlight
+from transcluder.deptracker import DependencyTracker, LRUDependencyTracker, ShardedDependencyTracker, SqliteDependencyTracker, make_resource_key
+from transcluder.cache import LRUCache, StalePolicy, is_cacheable
+from transcluder.fetchengine import FetchEngine
+from transcluder.connpool import ConnectionPool
+from transcluder.locked import locked
 
 
 TRANSCLUDED_HTTP_HEADER = 'HTTP_X_TRANSCLUDED'
 
+DOCTYPE_PAIR = ("-//W3C//DTD HTML 4.01 Transitional//EN",
+                "http://www.w3.org/TR/html4/loose.dtd")
+
+STREAMING_DROPPED_HEADERS = ('content-length', 'content-type', 'etag', 
+                             'last-modified', 'cache-control', 'expires')
+
+CHARSET_PAT = re.compile(r'charset\s*=\s*"?([^\s;"]+)', re.I)
+
 def is_conditional_get(environ):
     return 'HTTP_IF_MODIFIED_SINCE' in environ or 'HTTP_IF_NONE_MATCH' in environ
 
+class ResponseParser:
+    """
+    collects the body of a response as it arrives in chunks.  if 
+    the response is an html document (according to is_html on 
+    the middleware given) which contains transcluder links, the 
+    chunks are fed to an html parser in the charset of the 
+    response, as soon as both an html tag and a link have been 
+    seen and as they arrive after that.  html documents without 
+    links are not parsed.  
+    close() returns the (status, headers, body, parsed) tuple 
+    that etree_response would have returned for the whole body. 
+    """
+    def __init__(self, middleware, status, headers):
+        self.middleware = middleware
+        self.status = status
+        self.headers = headers
+        self._chunks = []
+        self._parser = None
+        self._encoding = None
+        self._sniffed = False
+        self._has_links = False
+        self._has_html_tag = False
+        self._feeding = False
+        self._tail = ''
+        self._tag_tail = ''
+        self._size = 0 
+
+        type = header_value(headers, 'content-type') or ''
+        if status.startswith('200') and middleware.is_html_type(headers):
+            charset = CHARSET_PAT.search(type)
+            if charset is not None:
+                self._encoding = charset.group(1)
+            self._parser = etree.HTMLParser(encoding=self._encoding)
+
+    def feed(self, chunk):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        if self._parser is None:
+            return
+
+        if self._feeding:
+            self._parser.feed(chunk)
+            return
+
+        if not self._has_links:
+            # the end of the previous chunk is searched again in 
+            # case a link was split between chunks 
+            window = self._tail + chunk
+            self._has_links = self.middleware.may_have_links(window)
+            self._tail = window[-64:]
+
+        limit = self.middleware.sniff_limit
+        start = self._size - len(chunk)
+        if not self._has_html_tag and (limit is None or start < limit):
+            # only the start of the body is searched for the html 
+            # tag, as is_html does 
+            window = self._tag_tail + chunk
+            if limit is not None:
+                window = window[:len(self._tag_tail) + limit - start]
+            self._has_html_tag = self.middleware.HTML_DOC_PAT.search(window) is not None
+            self._tag_tail = window[-64:]
+
+        if not self._sniffed:
+            if self._has_html_tag:
+                self._sniffed = True
+            elif limit is not None and self._size >= limit:
+                # the html tag would have been seen by now 
+                self._parser = None
+                return
+
+        if self._sniffed and self._has_links:
+            self._start_feeding()
+
+    def _sniff(self, body):
+        if self.middleware.is_html(self.status, self.headers, body):
+            self._sniffed = True
+        else:
+            self._parser = None
+
+    def _start_feeding(self):
+        self._feeding = True
+        for chunk in self._chunks:
+            self._parser.feed(chunk)
+
+    def close(self):
+        body = ''.join(self._chunks)
+        if self._parser is not None and not self._sniffed:
+            self._sniff(body)
+
+        parsed = None
+        if self._parser is not None:
+            if self._has_links and not self._feeding:
+                self._start_feeding()
+            if self._feeding:
+                parsed = self._parser.close()
+            else:
+                parsed = lxmlutils.UnparsedDocument(body, self._encoding)
+
+        return self.status, self.headers, body, parsed
+
 class TranscluderMiddleware:
     def __init__(self, app, deptracker = None, tasklist = None,
                  include_predicate=helpers.all_urls,
-                 recursion_predicate=helpers.all_urls): 
+                 recursion_predicate=helpers.all_urls,
+                 page_cache = None, fetch_engine = None,
+                 streaming = False, vary_cookies = None,
+                 rendered_cache = None, sniff_limit = 4096,
+                 feed_parser = False, include_timeout = None,
+                 connection_pool = None, single_flight = None,
+                 stale_policy = None, output_cache = None): 
 
         self.app = app
         self.include_predicate = include_predicate
         self.recursion_predicate = recursion_predicate
-        if deptracker:
+        if deptracker is not None:
             self.deptracker = deptracker
         else:
             self.deptracker = DependencyTracker()
@@ -48,6 +172,51 @@ class TranscluderMiddleware:
             self.tasklist = tasklist
         else:
             self.tasklist = TaskList()
+        if page_cache is not None:
+            self.page_cache = page_cache
+        else:
+            self.page_cache = LRUCache()
+        # lets concurrent requests including the same page share 
+        # one fetch of it, or None for each to make its own 
+        self.single_flight = single_flight
+        # lets pages kept in the page cache be included without 
+        # waiting for them to be revalidated, or None to always 
+        # revalidate them 
+        self.stale_policy = stale_policy
+        if rendered_cache is not None:
+            self.rendered_cache = rendered_cache
+        else:
+            self.rendered_cache = LRUCache()
+        # keeps whole transcluded pages, which are sent again 
+        # without being transcluded as long as none of the pages 
+        # they were made from has changed, or None to transclude 
+        # every page requested 
+        self.output_cache = output_cache
+        self.fetch_engine = fetch_engine
+        # keeps connections to external hosts open between fetches 
+        if connection_pool is not None:
+            self.connection_pool = connection_pool
+        else:
+            self.connection_pool = ConnectionPool()
+        # the number of bytes at the start of a text/html response 
+        # in which an html tag must appear for it to be transcluded, 
+        # or None to search the whole body 
+        self.sniff_limit = sniff_limit
+        self.feed_parser = feed_parser
+        self.streaming = streaming
+        # names of the cookies which can change which pages a 
+        # page includes; None means any cookie can. 
+        if vary_cookies is not None:
+            vary_cookies = frozenset(vary_cookies)
+        self.vary_cookies = vary_cookies
+        # the number of seconds after which a request stops waiting 
+        # for the pages it includes, or None to wait for them all 
+        self.include_timeout = include_timeout
+        self._lock = Lock()
+        # how many requests ran out of time, and how many pages 
+        # they gave up on 
+        self.deadline_hits = 0
+        self.timed_out_pages = 0
 
     def __call__(self, environ, start_response):
         if not environ.get('transcluder.transclude_response', True):
@@ -68,14 +237,39 @@ class TranscluderMiddleware:
 
         request_url = construct_url(environ)
         environ[TRANSCLUDED_HTTP_HEADER] = request_url
+
+        output_key = output = None
+        if (self.output_cache is not None and not is_conditional_get(environ) 
+            and 'HTTP_AUTHORIZATION' not in environ):
+            # keyed on every cookie, as the pages included may be 
+            # personalised by cookies vary_cookies leaves out.  a 
+            # page fetched with credentials is never kept. 
+            output_key = make_resource_key(request_url, environ)
+            output = self.output_cache.get(output_key)
+            if output is not None:
+                # check the pages the copy was made from as a request 
+                # conditional on its etag would 
+                environ['HTTP_IF_NONE_MATCH'] = output[0]
+                environ['transcluder.etags'] = parse_merged_etag(output[0])
+
+        if (self.include_timeout is not None and 
+            environ.get('transcluder.deadline') is None):
+            environ['transcluder.deadline'] = time.time() + self.include_timeout
         
         variables = self.get_template_vars(request_url)
         
         tc = Transcluder(variables, None,
                          should_include=self.include_predicate,
-                         should_recurse=self.recursion_predicate)
-
-        pm = PageManager(request_url, environ, self.deptracker, tc.find_dependencies, self.tasklist, self.etree_subrequest)
+                         should_recurse=self.recursion_predicate,
+                         splice=True,
+                         rendered_cache=self.rendered_cache)
+
+        pm = PageManager(request_url, environ, self.deptracker, tc.find_dependencies, self.tasklist, self.etree_subrequest,
+                         page_cache=self.page_cache,
+                         request_async=self.etree_subrequest_async,
+                         vary_cookies=self.vary_cookies,
+                         single_flight=self.single_flight,
+                         stale_policy=self.stale_policy)
         def simple_fetch(url):
             status, headers, body, parsed = pm.fetch(url)
             if status.startswith('200'):
@@ -84,49 +278,165 @@ class TranscluderMiddleware:
                 raise Exception, 'Status was: %s' % status 
             
         tc.fetch = simple_fetch
+        tc.digest = pm.content_digest
 
         if is_conditional_get(environ) and not pm.is_modified():
+            if output is not None:
+                self.count_deadline(pm)
+                return self.send_output(output, start_response)
             headers = [] 
             pm.merge_headers_into(headers)
+            self.count_deadline(pm)
             start_response('304 Not Modified', headers)
             return []
 
         pm.begin_speculative_gets() 
 
         status, headers, body, parsed = pm.fetch(request_url)
+        # the headers are also those of the copy kept in the page 
+        # cache, so they are changed on a copy 
+        headers = list(headers)
+
+        if (self.streaming and parsed is not None and 
+            tc.get_transcluder_links(parsed)):
+            headers = self.streaming_headers(headers)
+            start_response(status, headers)
+            return self.stream_transclusion(tc, parsed, request_url, pm)
 
         if parsed is not None: 
             if tc.transclude(parsed, request_url):
                 # XXX doctype 
-                body = lxmlutils.tostring(parsed, doctype_pair=("-//W3C//DTD HTML 4.01 Transitional//EN",
-                                                                "http://www.w3.org/TR/html4/loose.dtd"))
-            #else no need to change body at all
-            if isinstance(body, unicode):
+                body = tc.expand_placeholders(
+                    lxmlutils.tostring(parsed, doctype_pair=DOCTYPE_PAIR))
+                replace_header(headers, 'content-type', 'text/html; charset=utf-8')
+            elif isinstance(body, unicode):
                 body = body.encode('utf-8')
+                replace_header(headers, 'content-type', 'text/html; charset=utf-8')
+            #else no need to change body at all, it is still in the 
+            #encoding the application gave it 
             content_length = str(len(body))
                 
             replace_header(headers, 'content-length', content_length)
 
-            replace_header(headers, 'content-type', 'text/html; charset=utf-8')
-
         pm.merge_headers_into(headers)
+        self.count_deadline(pm)
         
         start_response(status, headers)
         if isinstance(body, unicode):
             body = body.encode('utf-8')
 
+        if output_key is not None:
+            self.keep_output(output_key, status, headers, body)
+
         return [body]
 
-    HTML_DOC_PAT = re.compile(r"^.*<\s*html(\s*|>).*$",re.I|re.M)
-    def is_html(self, status, headers, body):
+    def keep_output(self, key, status, headers, body):
+        """
+        stores a transcluded page in the output cache if it can 
+        be revalidated by its merged etag and none of the pages 
+        it was made from is private 
+        """
+        etag = header_value(headers, 'etag')
+        if etag is None or not is_cacheable(status, headers):
+            return
+        self.output_cache.put(key, (etag, status, list(headers), body), len(body))
+
+    def send_output(self, output, start_response):
+        """
+        sends a page kept by keep_output.  the pages it was made 
+        from have just been revalidated, so its expiry time is 
+        counted from now. 
+        """
+        etag, status, headers, body = output
+        headers = list(headers)
+        cache_control = parse_cache_directives(header_value(headers, 'cache-control'))
+        if 'max-age' in cache_control:
+            EXPIRES.update(headers, delta=int(cache_control['max-age']))
+        start_response(status, headers)
+        return [body]
+
+    def streaming_headers(self, headers):
+        """
+        returns the headers to send with a streamed response.  
+        these are the headers of the page requested, less those 
+        which would depend on included pages that have not been 
+        fetched yet: the body length, validators and freshness 
+        information are dropped and caches are told to revalidate. 
+        Set-Cookie headers of included pages are not forwarded. 
+        """
+        headers = [(name, value) for name, value in headers 
+                   if name.lower() not in STREAMING_DROPPED_HEADERS]
+        headers.append(('Content-Type', 'text/html; charset=utf-8'))
+        headers.append(('Cache-Control', 'no-cache'))
+        return headers
+
+    @locked
+    def count_deadline(self, pm):
+        """
+        adds the pages which the page manager given gave up on to 
+        the counts of deadlines hit 
+        """
+        if pm.deadline_hit:
+            self.deadline_hits += 1
+            self.timed_out_pages += len(pm.timed_out)
+
+    def stream_transclusion(self, tc, document, document_url, pm=None):
+        """
+        yields the transcluded document in pieces: everything up 
+        to the first include link as soon as it is available, then 
+        each include followed by the document text up to the next 
+        include, as each include is completed in document order. 
+        """
+        cache = {}
+        marker = 'transcluder-slot-%x' % id(document)
+        slots = []
+        for link in tc.get_transcluder_links(document):
+            placeholder = etree.Comment(marker)
+            lxmlutils.replace_element(link, placeholder)
+            # move the link into a document of its own so that it 
+            # can be transcluded and serialized separately 
+            slot = etree.Element('div')
+            link.tail = None
+            slot.append(link)
+            slots.append(slot)
+
+        pieces = lxmlutils.tostring(document, doctype_pair=DOCTYPE_PAIR).split('<!--%s-->' % marker)
+        assert len(pieces) == len(slots) + 1
+
+        yield pieces[0]
+        for slot, piece in zip(slots, pieces[1:]):
+            tc.transclude(slot, document_url, _cache=cache)
+            yield tc.expand_placeholders(lxmlutils.inner_html(slot)) + piece
+
+        if pm is not None:
+            self.count_deadline(pm)
+
+    HTML_DOC_PAT = re.compile(r"<\s*html", re.I)
+    def is_html_type(self, headers):
         type = header_value(headers, 'content-type')
-        if type and (type.startswith('text/html') or type.startswith('application/xhtml+xml')):
-            if self.HTML_DOC_PAT.search(body) is not None:
+        return bool(type) and (type.startswith('text/html') or 
+                               type.startswith('application/xhtml+xml'))
+
+    def is_html(self, status, headers, body):
+        if self.is_html_type(headers):
+            # only the start of the body is searched for the html tag
+            endpos = self.sniff_limit
+            if endpos is None:
+                endpos = len(body)
+            if self.HTML_DOC_PAT.search(body, 0, endpos) is not None:
                 return True
             
         return False
 
 
+    INCLUDE_LINK_PAT = re.compile(r"""rel\s*=\s*["']?\s*include""", re.I)
+    def may_have_links(self, body):
+        """
+        false if the html given certainly contains no transcluder 
+        links, so that it need not be parsed to look for them
+        """
+        return self.INCLUDE_LINK_PAT.search(body) is not None
+
     def get_template_vars(self, url): 
         return helpers.make_uri_template_dict(url)
 
@@ -148,32 +458,215 @@ class TranscluderMiddleware:
         if len(url_parts[4]):
             env['QUERY_STRING'] = url_parts[4]
 
+        source = self.subrequest_source(url, effective_url, environ)
+        if self.feed_parser and source == 'self':
+            return self.feed_subrequest(self.app, environ)
+        elif self.feed_parser and source == 'internal':
+            return self.feed_subrequest(*self.internal_subrequest(url, env))
+        elif source == 'self':
+            req = Request(environ)
+            res = req.get_response(self.app)
+            status, headers, body = res.status, res.headerlist, res.unicode_body
+        elif source == 'file':
+            status, headers, body = get_file_resource(file, env)
+        elif source == 'internal':
+            status, headers, body = get_internal_resource(url, env, self.app, add_to_environ=self.internal_environ(env))
+        elif url.startswith('http:') or url.startswith('https:'):
+            status, headers, body = self.connection_pool.get_resource(url, env)
+        else:
+            status, headers, body = get_external_resource(url, env)
+
+        return self.etree_response(status, headers, body)
+
+    def etree_subrequest_async(self, url, environ, callback):
+        """
+        if there is a fetch engine and the url given is an external 
+        http url, start fetching it on the engine and return True. 
+        callback is later called on a worker thread with what 
+        etree_subrequest would 
+        have returned and None, or None and the exc_info of the 
+        failure. otherwise return False, and the url should be 
+        fetched with etree_subrequest. 
+        """
+        if self.fetch_engine is None or not url.startswith('http:'):
+            return False
+
+        effective_url = self.premangle_subrequest(url, environ)
+        if self.subrequest_source(url, effective_url, environ) != 'external':
+            return False
+
+        # the response is parsed, and any failure reported, on a 
+        # worker thread, so that the engine's loop is free to go 
+        # on with other fetches 
+        def parse(response, error):
+            if error is not None:
+                callback(None, error)
+                return
+            try:
+                if self.feed_parser:
+                    status, headers, body = response
+                    parser = ResponseParser(self, status, headers)
+                    parser.feed(body)
+                    response = parser.close()
+                else:
+                    response = self.etree_response(*response)
+            except:
+                callback(None, sys.exc_info())
+            else:
+                callback(response, None)
+
+        def got_response(response, error):
+            self.tasklist.hand_off(parse, response, error)
+
+        self.fetch_engine.get_external_resource(url, environ, got_response)
+        return True
+
+    def internal_environ(self, environ):
+        """
+        returns the keys added to the environ of subrequests 
+        made to the wrapped application 
+        """
+        return {'transcluder.transclude_response': False,
+                TRANSCLUDED_HTTP_HEADER: environ[TRANSCLUDED_HTTP_HEADER]}
+
+    def internal_subrequest(self, url, environ):
+        """
+        returns the application and environ with which 
+        get_internal_resource would request the url given 
+        """
+        add_to_environ = self.internal_environ(environ)
+        if 'paste.recursive.include' in environ:
+            includer = environ['paste.recursive.include']
+            env = prep_environ(url, in_environ=includer.original_environ)
+            env.update(add_to_environ)
+            env['paste.recursive.include'] = includer
+            return includer.application, env
+
+        env = prep_environ(url, in_environ=environ)
+        env.update(add_to_environ)
+        return self.app, env
+
+    def feed_subrequest(self, app, environ):
+        """
+        calls the wsgi application given, parsing the body as 
+        it is produced.  returns what etree_response would have 
+        returned for the whole response. 
+        """
+        parsers = []
+        def start_response(status, headers, exc_info=None):
+            parsers[:] = [ResponseParser(self, status, headers)]
+            return parsers[0].feed
+
+        app_iter = app(environ, start_response)
+        try:
+            for chunk in app_iter:
+                parsers[0].feed(chunk)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        return parsers[0].close()
+
+    def subrequest_source(self, url, effective_url, environ):
+        """
+        returns 'self' if url is the url of the request being 
+        transcluded, 'file' for file urls, 'internal' if the url 
+        is served by the wrapped application and 'external' 
+        otherwise. 
+        """
+        url_parts = urlparse(effective_url)
 
         request_url = construct_url(environ, with_path_info=False,
                                     with_query_string=False)
         request_url_parts = urlparse(request_url)
 
         if url == construct_url(environ):
-
-            req = Request(environ)
-            res = req.get_response(self.app)
-            status, headers, body = res.status, res.headerlist, res.unicode_body
+            return 'self'
         elif url_parts[0] == 'file':
-            status, headers, body = get_file_resource(file, env)
+            return 'file'
         elif request_url_parts[0:2] == url_parts[0:2]:
-            status, headers, body = get_internal_resource(url, env, self.app, add_to_environ={'transcluder.transclude_response': False,
-                                                                                                 TRANSCLUDED_HTTP_HEADER: env[TRANSCLUDED_HTTP_HEADER]})
+            return 'internal'
         else:
-            status, headers, body = get_external_resource(url, env)
+            return 'external'
 
-        if status.startswith('200') and self.is_html(status, headers, body):
+    def etree_response(self, status, headers, body):
+        """
+        adds the parsed document to a subrequest response, or 
+        None if the response is not an html document.  documents 
+        which contain no transcluder links are left unparsed. 
+        """
+        if not (status.startswith('200') and self.is_html(status, headers, body)):
+            parsed = None
+        elif self.may_have_links(body):
             parsed = etree.HTML(body)
         else:
-            parsed = None
+            parsed = lxmlutils.UnparsedDocument(body)
 
         return status, headers, body, parsed
 
+def asbool(value):
+    return str(value).strip().lower() in ('true', 'yes', 'on', 'y', 't', '1')
+
 def make_filter(global_conf, **app_conf):
     def filter(app):
-        return TranscluderMiddleware(app)
+        kw = {}
+        max_deps = app_conf.get('deptracker_max_entries')
+        if max_deps is not None:
+            max_deps = int(max_deps)
+        if app_conf.get('deptracker_file'):
+            kw['deptracker'] = SqliteDependencyTracker(app_conf['deptracker_file'], 
+                                                       max_entries=max_deps)
+        elif max_deps is not None:
+            kw['deptracker'] = LRUDependencyTracker(max_deps)
+        elif 'deptracker_shards' in app_conf:
+            kw['deptracker'] = ShardedDependencyTracker(int(app_conf['deptracker_shards']))
+        if 'page_cache_size' in app_conf:
+            kw['page_cache'] = LRUCache(int(app_conf['page_cache_size']))
+        if 'rendered_cache_size' in app_conf:
+            kw['rendered_cache'] = LRUCache(int(app_conf['rendered_cache_size']))
+        if 'output_cache_size' in app_conf:
+            kw['output_cache'] = LRUCache(int(app_conf['output_cache_size']))
+        if 'sniff_limit' in app_conf:
+            if app_conf['sniff_limit'].strip().lower() == 'none':
+                kw['sniff_limit'] = None
+            else:
+                kw['sniff_limit'] = int(app_conf['sniff_limit'])
+        if asbool(app_conf.get('feed_parser')):
+            kw['feed_parser'] = True
+        if asbool(app_conf.get('fetch_engine')):
+            kw['fetch_engine'] = FetchEngine()
+        if asbool(app_conf.get('single_flight')):
+            kw['single_flight'] = SingleFlight()
+        if asbool(app_conf.get('streaming')):
+            kw['streaming'] = True
+        if ('fetch_queue_size' in app_conf or 'fetch_queue_overflow' in app_conf or 
+            'fetch_origin_limit' in app_conf):
+            max_queued = app_conf.get('fetch_queue_size')
+            if max_queued is not None:
+                max_queued = int(max_queued)
+            max_per_origin = app_conf.get('fetch_origin_limit')
+            if max_per_origin is not None:
+                max_per_origin = int(max_per_origin)
+            kw['tasklist'] = TaskList(max_queued=max_queued, 
+                                      overflow=app_conf.get('fetch_queue_overflow', 'block'), 
+                                      max_per_origin=max_per_origin)
+        if ('connection_pool_max_idle' in app_conf or 
+            'connection_pool_max_per_host' in app_conf or 
+            'connection_pool_idle_timeout' in app_conf):
+            pool_kw = {}
+            if 'connection_pool_max_idle' in app_conf:
+                pool_kw['max_idle'] = int(app_conf['connection_pool_max_idle'])
+            if 'connection_pool_max_per_host' in app_conf:
+                pool_kw['max_per_host'] = int(app_conf['connection_pool_max_per_host'])
+            if 'connection_pool_idle_timeout' in app_conf:
+                pool_kw['idle_timeout'] = float(app_conf['connection_pool_idle_timeout'])
+            kw['connection_pool'] = ConnectionPool(**pool_kw)
+        if asbool(app_conf.get('serve_stale')):
+            kw['stale_policy'] = StalePolicy(
+                stale_while_revalidate=int(app_conf.get('stale_while_revalidate', 0)),
+                stale_if_error=int(app_conf.get('stale_if_error', 0)))
+        if 'include_timeout' in app_conf:
+            kw['include_timeout'] = float(app_conf['include_timeout'])
+        if 'vary_cookies' in app_conf:
+            kw['vary_cookies'] = app_conf['vary_cookies'].replace(',', ' ').split()
+        return TranscluderMiddleware(app, **kw)
     return filter
@@ -6,17 +6,21 @@
 
 from sets import Set
 from copy import copy 
+from hashlib import sha1
+from collections import deque
 from threading import Lock, RLock, Condition
 from enum import Enum
-from avl import new as avl
 from transcluder.cookie_wrapper import * 
+from paste.response import header_value
 from wsgifilter.cache_utils import merge_cache_headers, parse_merged_etag
-from transcluder.threadpool import WorkRequest, ThreadPool
+from transcluder.threadpool import WorkRequest, ThreadPool, WorkerThread
 from transcluder.deptracker import make_resource_key
+from transcluder.cache import is_cacheable, add_validators
 from locked import locked
 import sys
 import time 
 import threading
+import urlparse
 
 class trackingSet(Set):
     def __init__(self, *args):
@@ -69,53 +73,242 @@ class trackingSet(Set):
 #     def notifyAll(self):
 #         return self._condition.notifyAll()
 
+class QueueFull(Exception):
+    """
+    raised when a task is pushed onto a fetch list while the 
+    task list already holds as many tasks as it may 
+    """
+    pass
+
+OVERFLOW_POLICIES = ('block', 'inline', 'fail')
+
+DEFAULT_PORTS = {'http' : 80, 'https' : 443}
+
+def url_origin(url):
+    """
+    returns the (scheme, host, port) of the url given
+
+    >>> url_origin('http://Example.com/a.html')
+    ('http', 'example.com', 80)
+    >>> url_origin('http://example.com:8080/a.html')
+    ('http', 'example.com', 8080)
+    """
+    parts = urlparse.urlsplit(url)
+    port = parts.port or DEFAULT_PORTS.get(parts.scheme)
+    return parts.scheme, parts.hostname, port
+
 class TaskList:
-    def __init__(self, poolsize=30):
-        self._fetchlists = avl()
+    """
+    hands the tasks queued on registered FetchLists to the 
+    worker threads.  Only fetch lists with tasks waiting are 
+    kept in the ready queue, which is served round robin, so 
+    picking the next task does not depend on the number of 
+    page requests in progress. 
+
+    poolsize - the number of worker threads
+
+    max_queued - the number of tasks which may be waiting on 
+      all fetch lists together, or None for no limit 
+
+    overflow - what a page manager does with a task when 
+      max_queued tasks are already waiting: 
+        'block' - the thread serving the page waits for room, 
+          working through the page's own tasks meanwhile 
+        'inline' - the task is performed at once by the thread 
+          which wanted it queued 
+        'fail' - the page is given a 503 response without 
+          being fetched, so that its include fails with a 
+          warning 
+
+    max_per_origin - the number of tasks for the same scheme, 
+      host and port which worker threads may perform at once, 
+      or None for no limit 
+    """
+    def __init__(self, poolsize=30, max_queued=None, overflow='block', 
+                 max_per_origin=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r" % overflow)
+        self._ready = deque()
         self._lock = RLock()
         self.cv = Condition(self._lock)
         self.next_task_list_index = 0
         self.alive = True
+
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.queued = 0 
+        # only ever held on its own, so that fetch lists can 
+        # count their tasks while holding their own locks 
+        self._count_lock = Lock()
+        # notified when queued tasks leave their fetch lists 
+        self.room = Condition(self._count_lock)
+
+        self.max_per_origin = max_per_origin
+        self._active = {}
+
+        # work passed over by hand_off 
+        self._handed_off = deque()
+
+        # tasks which no page is waiting for 
+        self.background = FetchList(self)
+        self.put_list(self.background)
+
         self.threadpool = ThreadPool(poolsize, self)
 
     def kill(self):
         self.alive = False
+        self.threadpool.dismissWorkers(len(self.threadpool.workers))
         self.notifyAll()
+        with self.room:
+            self.room.notifyAll()
 
     def get(self):     
-        self.cv.acquire()
-        while self.alive:
-            for list in self._fetchlists:
-                task = list.pop()
-                if task:
-                    self.cv.release()
+        if self.max_per_origin is not None:
+            can_start = self._can_start
+        else:
+            can_start = None
+
+        with self.cv:
+            while self.alive:
+                if self._handed_off:
+                    return self._handed_off.popleft()
+
+                # lists whose tasks are all for origins at their 
+                # limit are put back after the others 
+                waiting = []
+                task = None
+                while self._ready and task is None:
+                    list = self._ready.popleft()
+                    list.ready = False
+                    if not list.registered:
+                        continue
+                    task = list.pop(can_start)
+                    if not len(list):
+                        continue
+                    if task is None:
+                        waiting.append(list)
+                    else:
+                        list.ready = True
+                        self._ready.append(list)
+
+                for list in waiting:
+                    list.ready = True
+                    self._ready.append(list)
+
+                if task is not None:
+                    if can_start is not None:
+                        self._start(task)
                     return task
-            self.cv.wait()
+                self.cv.wait()
+            return None
+
+    @locked
+    def hand_off(self, callable, *args):
+        """
+        has a worker thread call callable with the arguments given 
+        before starting any queued task.  lets threads which must 
+        not block, like the fetch engine's loop, pass work on. 
+        """
+        self._handed_off.append(WorkRequest(callable, args))
+        self.cv.notify()
+
+    def reserve(self, bounded=True):
+        """
+        counts a task about to be queued.  returns False if the 
+        task list is full and bounded is true. 
+        """
+        with self._count_lock:
+            if (bounded and self.max_queued is not None and 
+                self.queued >= self.max_queued):
+                return False
+            self.queued += 1
+            return True
 
+    def dequeued(self, count):
+        """
+        called when tasks counted by reserve leave their fetch list 
+        """
+        if not count:
+            return
+        with self.room:
+            self.queued -= count
+            self.room.notifyAll()
+
+    def wait_for_room(self, timeout=None):
+        """
+        waits until a task could be queued on a bounded fetch 
+        list, or for at most timeout seconds 
+        """
+        with self.room:
+            if (self.alive and self.max_queued is not None and 
+                self.queued >= self.max_queued):
+                self.room.wait(timeout)
+
+    def _can_start(self, task):
+        return self._active.get(task.origin, 0) < self.max_per_origin
+
+    def _start(self, task):
+        self._active[task.origin] = self._active.get(task.origin, 0) + 1
+        task.tasklist = self
+
+    @locked
+    def finished(self, task):
+        """
+        called when a task handed out by get has its response 
+        """
+        count = self._active[task.origin] - 1
+        if count:
+            self._active[task.origin] = count
+        else:
+            del self._active[task.origin]
+        # a list may have been passed over for this origin 
+        self.cv.notifyAll()
 
     @locked
     def put_list(self, list):        
-        #assert list not in self._fetchlists
         if not hasattr(list, 'task_list_index'):
             list.task_list_index = self.next_task_list_index
             self.next_task_list_index += 1
-        self._fetchlists.insert(list)
+        list.registered = True
+        if not list.ready and len(list):
+            list.ready = True
+            self._ready.append(list)
         #about to notify
         self.cv.notifyAll() 
 
+    def refresh(self, task):
+        """
+        queues a task on the background list, unless the task 
+        list is full 
+        """
+        try:
+            self.background.push(task)
+        except QueueFull:
+            pass
+
     @locked
     def remove_list(self, list):
-        self._fetchlists.remove(list)
+        # the list is dropped from the ready queue when it 
+        # is next reached 
+        list.registered = False
 
-    def notify(self): 
-        self.cv.acquire()
+    @locked
+    def mark_ready(self, list):
+        """
+        called when a task is pushed onto the list given 
+        """
+        if list.registered and not list.ready:
+            list.ready = True
+            self._ready.append(list)
         self.cv.notify()
-        self.cv.release() 
+
+    def notify(self): 
+        with self.cv:
+            self.cv.notify()
 
     def notifyAll(self): 
-        self.cv.acquire()
-        self.cv.notifyAll()
-        self.cv.release() 
+        with self.cv:
+            self.cv.notifyAll()
 
 
 class FetchList: 
@@ -126,32 +319,49 @@ class FetchList:
         self._pending = Set()
         self._in_progress = Set()
 
-
-    def push(self, task): 
-        self._lock.acquire()
-        try:
+        # maintained by the task list 
+        self.registered = False
+        self.ready = False
+
+    def push(self, task, bounded=True): 
+        """
+        queues the task given unless a task for its url is 
+        already queued or in progress, returning whether it was 
+        queued.  raises QueueFull if the task list is full, 
+        unless bounded is false. 
+        """
+        with self._lock:
             if (not task.url in self._pending and 
                 not task.url in self._in_progress): 
+                if not self.tasklist.reserve(bounded):
+                    raise QueueFull(task.url)
                 self._tasks[0:0] = [task]
                 self._pending.add(task.url)
                 pushed = True
             else:
                 pushed = False 
-        finally: 
-            self._lock.release() 
 
-        self.tasklist.notify() 
+        if pushed:
+            self.tasklist.mark_ready(self)
         return pushed
 
     @locked 
-    def pop(self): 
-        if len(self._tasks):
-            task = self._tasks.pop()
-            self._pending.remove(task.url)
-            self._in_progress.add(task.url)
-            return task 
-        else: 
-            return None
+    def pop(self, can_start=None): 
+        """
+        takes the oldest task off the list, or if can_start is 
+        given, the oldest task for which it returns true 
+        """
+        index = len(self._tasks) - 1
+        while index >= 0:
+            task = self._tasks[index]
+            if can_start is None or can_start(task):
+                del self._tasks[index]
+                self._pending.remove(task.url)
+                self._in_progress.add(task.url)
+                self.tasklist.dequeued(1)
+                return task 
+            index -= 1
+        return None
 
     @locked 
     def __len__(self): 
@@ -159,18 +369,19 @@ class FetchList:
 
     @locked 
     def clear(self): 
+        self.tasklist.dequeued(len(self._tasks))
         self._tasks = []
         self._pending = Set()
 
     @locked
-    def remove_if_mods(self):
-        tasks = self._tasks
-        self._tasks = []
-        for task in tasks:
-            if task.request_type != RequestType.conditional_get:
-                self._tasks.append(task)
-            else:
-                self._pending.remove(task.url)
+    def convert_conditional_gets(self):
+        """
+        turns the conditional gets which have not been started 
+        into gets of the same pages, keeping their places 
+        """
+        for task in self._tasks:
+            if task.request_type == RequestType.conditional_get:
+                task.request_type = RequestType.get
 
     @locked 
     def completed(self, task): 
@@ -187,16 +398,59 @@ class FetchList:
             tasks = [t for t in self._tasks if t.url == url]
             assert len(tasks) == 0 or len(tasks) == 1
             self._tasks.remove(tasks[0])
+            self.tasklist.dequeued(1)
 
         self._in_progress.add(url)
 
         return True
 
+class SingleFlight:
+    """
+    lets concurrent fetches of the same resource share a single 
+    request.  the first fetch of a key becomes its leader and 
+    makes the request; fetches of the key made before the leader 
+    has its response wait for that response instead. 
+
+    shared counts the fetches which did not make a request of 
+    their own. 
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._followers = {}
+        self.shared = 0
+
+    @locked
+    def join(self, key, callback):
+        """
+        returns False if no fetch of the key given is in flight, 
+        making the caller its leader.  otherwise 
+        returns True, and callback is called with the (response, 
+        error) of the leader when it has them. 
+        """
+        if key in self._followers:
+            self._followers[key].append(callback)
+            self.shared += 1
+            return True
+        self._followers[key] = []
+        return False
+
+    @locked
+    def done(self, key):
+        """
+        called by the leader of the key given when it has its 
+        response, returning the callbacks of its followers.  
+        later fetches of the key make a new request. 
+        """
+        return self._followers.pop(key)
+
 def join_cookies(cookies):
     return ";".join(['%s=%s' % (c['name'], c['value']) for c in cookies])
 
 RequestType = Enum('conditional_get', 'get')
 
+TIMEOUT_STATUS = '504 Gateway Timeout'
+TIMEOUT_MESSAGE = "the deadline for the request passed before this page was fetched"
+
 class FetchListItem(WorkRequest): 
     def __init__(self, url, environ, 
                  request_type, 
@@ -205,10 +459,41 @@ class FetchListItem(WorkRequest):
         self.environ = environ.copy() 
         self.request_type = request_type 
         self.page_manager = page_manager 
+        self.origin = url_origin(url)
+        # set by the task list while the task counts against the 
+        # limit for its origin 
+        self.tasklist = None
+        # true for responses made up without fetching the url 
+        self.synthetic = False
+        # whether the task may make a request which other pages 
+        # fetching the same resource share 
+        self._cached = None
+        # a copy of the page which may be used if it cannot be fetched 
+        self._stale = None
         WorkRequest.__init__(self, self)
 
     def __call__(self):
-        self._do_fetch() 
+        try:
+            self._do_fetch() 
+        except:
+            self._finished()
+            raise
+
+    def _finished(self):
+        if self.tasklist is not None:
+            tasklist = self.tasklist
+            self.tasklist = None
+            tasklist.finished(self)
+
+    def fail(self, status, message):
+        """
+        completes the task with the response status given 
+        instead of fetching the url 
+        """
+        self.synthetic = True
+        self._cached = None
+        self._stale = None
+        self._got_response((status, [], message, None), None)
         
     def _do_fetch(self):
         # XXX transcluder dependency
@@ -229,33 +514,218 @@ class FetchListItem(WorkRequest):
             if 'HTTP_IF_NONE_MATCH' in self.environ:
                 del self.environ['HTTP_IF_NONE_MATCH']
 
+        if self._past_deadline():
+            self.fail(TIMEOUT_STATUS, TIMEOUT_MESSAGE)
+            return
+
+        # revalidate any copy of the page kept from an earlier request 
+        # instead of fetching and parsing it again 
+        self._cached = self._get_cached()
+        if self._cached is not None and self.request_type == RequestType.get:
+            if self._use_kept_copy():
+                return
+            add_validators(self.environ, self._cached[1])
+
+        # a response to a request made with credentials is never 
+        # shared, even with a request made with the same ones 
+        flights = self.page_manager.single_flight
+        if flights is not None and 'HTTP_AUTHORIZATION' not in self.environ:
+            self._flight_key = (make_resource_key(self.url, self.environ), 
+                                self.request_type, 
+                                self.environ.get('HTTP_COOKIE'), 
+                                self.environ.get('HTTP_AUTHORIZATION'), 
+                                self.environ.get('HTTP_IF_NONE_MATCH'), 
+                                self.environ.get('HTTP_IF_MODIFIED_SINCE'))
+            if flights.join(self._flight_key, self._got_leader_response):
+                # another page is fetching the same thing, so this 
+                # task no longer holds up its origin 
+                self._finished()
+                return
+            self._request(self._got_shared_response)
+        else:
+            self._request(self._got_response)
+
+    def _request(self, got_response):
+        request_async = self.page_manager.request_async
+        if (request_async is not None and 
+            request_async(self.url, self.environ, got_response)):
+            return
+
         try:
-            self.response = self.page_manager.request(self.url, self.environ)
+            response = self.page_manager.request(self.url, self.environ)
         except:
-            exc_class, exc, tb = sys.exc_info()
-            #transmute response to 500.  Boy does this suck!  We need this
-            #because httplib2 raises string exceptions, which are the worst
-            #thing ever.
-            if isinstance(exc_class, basestring):
-                self.response = ('500 transmuted socket-layer error', [], "the error is: %s" % exc_class, None)
-            else:
-                self.response = ('500 server error', [], "the error is: %s" % exc, None)
-            import traceback
-            print >> self.environ['wsgi.errors'], "Error fetching transcluder resource %s:" % self.url
-            traceback.print_exc(file=self.environ['wsgi.errors'])
-            print >> self.environ['wsgi.errors'], '-'*60
+            got_response(None, sys.exc_info())
+        else:
+            got_response(response, None)
+
+    def _got_leader_response(self, response, error):
+        """
+        called with the response to the fetch this task joined.  a 
+        response setting cookies belongs to the page which asked 
+        for it, so the task makes a request of its own instead, on 
+        a worker thread. 
+        """
+        if error is None and header_value(response[1], 'set-cookie') is not None:
+            self.page_manager.tasklist.hand_off(self._request, self._got_response)
+        else:
+            self._got_response(response, error)
+
+    def _got_shared_response(self, response, error):
+        followers = self.page_manager.single_flight.done(self._flight_key)
+        try:
+            self._got_response(response, error)
+        finally:
+            for callback in followers:
+                try:
+                    callback(response, error)
+                except:
+                    import traceback
+                    print >> sys.stderr, "Error handing shared response for %s to %r:" % (self.url, callback)
+                    traceback.print_exc(file=sys.stderr)
+                    print >> sys.stderr, '-'*60
+
+    def _past_deadline(self):
+        return self.page_manager.past_deadline(self.url)
+
+    def _use_kept_copy(self):
+        """
+        completes the task with the copy of the page found in the 
+        page cache if the stale policy of the page manager lets it 
+        be used without waiting for it to be revalidated, and 
+        returns True.  a stale copy is refetched in the background. 
+        """
+        policy = self.page_manager.stale_policy
+        if policy is None:
+            return False
+
+        age = time.time() - self._cached_at
+        fresh, while_revalidate, if_error = policy.lifetimes(self._cached[1])
+        if age < fresh + if_error:
+            self._stale = self._cached
+        if age >= fresh + while_revalidate:
+            return False
+
+        if age >= fresh:
+            self.page_manager.tasklist.refresh(
+                RefreshItem(self.url, self.environ, self.request_type, 
+                            self.page_manager))
+        self._finished()
+        self.response = self._cached
+        self.page_manager.got_non_redirect(self)
+        self.page_manager.run_overflow()
+        return True
+
+    def _got_response(self, response, error):
+        self._finished()
+        if error is not None:
+            response = self._error_response(error)
+        self.response = response
+
+        if self._cached is not None and self.response[0].startswith('304'):
+            # the copy kept is good for as long again 
+            self._put_cached(self._cached)
+            if self.request_type == RequestType.get:
+                self.response = self._cached
+        elif self._stale is not None and self.response[0].startswith('5'):
+            self.response = self._stale
+        else:
+            self._put_cached(self.response)
 
         if self.response[0].startswith('304'):
             self.page_manager.got_304(self)
         else:
             self.page_manager.got_non_redirect(self)
+        self.page_manager.run_overflow()
+
+    def _error_response(self, error):
+        exc_class, exc, tb = error
+        #transmute response to 500.  Boy does this suck!  We need this
+        #because httplib2 raises string exceptions, which are the worst
+        #thing ever.
+        if isinstance(exc_class, basestring):
+            response = ('500 transmuted socket-layer error', [], "the error is: %s" % exc_class, None)
+        else:
+            response = ('500 server error', [], "the error is: %s" % exc, None)
+        import traceback
+        print >> self.environ['wsgi.errors'], "Error fetching transcluder resource %s:" % self.url
+        traceback.print_exception(exc_class, exc, tb, file=self.environ['wsgi.errors'])
+        print >> self.environ['wsgi.errors'], '-'*60
+        return response
+
+    def _get_cached(self):
+        """
+        returns the copy of the page kept in the page cache.  for 
+        a conditional get, it is only returned if a 304 response 
+        would show it to be current. 
+        """
+        cache = self.page_manager.page_cache
+        if cache is None or 'HTTP_AUTHORIZATION' in self.environ:
+            return None
+        entry = cache.get(make_resource_key(self.url, self.environ))
+        if entry is None:
+            return None
+        response, self._cached_at = entry
+        if self.request_type == RequestType.conditional_get:
+            headers = response[1]
+            if 'HTTP_IF_NONE_MATCH' in self.environ:
+                if header_value(headers, 'etag') != self.environ['HTTP_IF_NONE_MATCH']:
+                    return None
+            elif (header_value(headers, 'last-modified') != 
+                  self.environ.get('HTTP_IF_MODIFIED_SINCE')):
+                return None
+        return response
+
+    def _put_cached(self, response):
+        cache = self.page_manager.page_cache
+        if cache is None:
+            return
+        status, headers, body, parsed = response
+        if is_cacheable(status, headers, self.environ):
+            # only the body is counted; the parsed tree is not 
+            cache.put(make_resource_key(self.url, self.environ),
+                      (response, time.time()), len(body))
 
     def archive_info(self): 
         return self.response
 
+    def kept_copy(self):
+        """
+        the copy of the page from the page cache which a 304 
+        response to the task showed to be current, or None 
+        """
+        if self.response[0].startswith('304'):
+            return self._cached
+        return None
+
     def __str__(self):
         return "FetchListItem(%s, %s)" % (self.url, self.request_type)
 
+class RefreshItem(FetchListItem):
+    """
+    refetches a page into the page cache in the background after 
+    a stale copy of it has been used.  the page keeps the stale 
+    copy if the page cannot be fetched. 
+    """
+    def _past_deadline(self):
+        return False
+
+    def _use_kept_copy(self):
+        return False
+
+    def _got_response(self, response, error):
+        self._finished()
+        try:
+            if error is not None:
+                response = self._error_response(error)
+            self.response = response
+            if self._cached is not None and response[0].startswith('304'):
+                self.response = self._cached
+                self._put_cached(self.response)
+            elif not response[0].startswith('5'):
+                self._put_cached(self.response)
+        finally:
+            self.page_manager.tasklist.background.completed(self)
+
 PMState = Enum(
     'initial', 
     'check_modification',
@@ -266,23 +736,47 @@ PMState = Enum(
 
 class PageManager: 
     def __init__(self, request_url, environ, deptracker, 
-                 find_dependencies, tasklist, request_func): 
+                 find_dependencies, tasklist, request_func,
+                 page_cache=None, request_async=None,
+                 vary_cookies=None, single_flight=None,
+                 stale_policy=None): 
 
         self.deptracker = deptracker 
         self.tasklist = tasklist 
+        self.page_cache = page_cache
+        self.single_flight = single_flight
+        self.stale_policy = stale_policy
         self.fetchlist = FetchList(tasklist) 
         self.find_dependencies = find_dependencies
         self.request = request_func
+        self.request_async = request_async
+        self.vary_cookies = vary_cookies
 
         self._request_url = request_url
         self._environ = environ.copy()
-        self._root_resource = make_resource_key(self._request_url, self._environ)
+        # the thread serving the page, which may wait for room 
+        # in the task list 
+        self._thread = threading.currentThread()
+        # the time after which the page manager stops waiting for 
+        # pages, or None to wait for as long as they take 
+        self._deadline = environ.get('transcluder.deadline')
+        self.deadline_hit = False
+        # pages given a 504 response because of the deadline 
+        self.timed_out = Set()
+        self._root_resource = self._resource_key(self._request_url)
         self._page_archive = {}         
+        self._digests = {}
 
 
         self._speculative_dep_info = {} 
         self._needed = Set() 
         self._actual_deps = Set()
+        # copies of pages which a conditional get showed to be 
+        # current, used if the page turns out to need its content 
+        self._validated = {}
+        # tasks left by _queue for run_overflow 
+        self._overflow = deque()
+        self._blocked = deque()
 
         self._lock = RLock()
         self.cv = Condition(self._lock)
@@ -293,6 +787,13 @@ class PageManager:
     def __cmp__(self, other):
         return self.task_list_index - other.task_list_index    
 
+    def _resource_key(self, url):
+        """
+        the key the dependencies of the page at the url given 
+        are tracked under 
+        """
+        return make_resource_key(url, self._environ, self.vary_cookies)
+
     def is_modified(self): 
         if (self._state == PMState.modified or self._state == PMState.done or 
             self._state == PMState.get_pages):
@@ -317,21 +818,34 @@ class PageManager:
 
         self.tasklist.put_list(self.fetchlist)
         initial_requests = [request_url] 
-        initial_requests += self.deptracker.get_all_deps(self._root_resource)
+        # a page which includes itself is only checked once 
+        for url in self.deptracker.get_all_deps(self._root_resource, 
+                                                self._resource_key):
+            if url not in initial_requests:
+                initial_requests.append(url)
         self.expected_mod_responses = len(initial_requests)
             
         for url in initial_requests: 
             self.add_conditional_get(url)
 
         while self._state == PMState.check_modification:
+            self.run_overflow()
             self.cv.acquire() 
-            task = self.fetchlist.pop()
+            task = None
+            if self._deadline is None:
+                # with a deadline the checks are left to the worker 
+                # threads, so that this thread can stop waiting for 
+                # them at the deadline 
+                task = self.fetchlist.pop()
             if task:
                 self.cv.release()
                 task()
             else: 
-                if self._state == PMState.check_modification: 
-                    self.cv.wait() 
+                if (self._state == PMState.check_modification and 
+                    not self._wait()): 
+                    # the pages could not all be checked in time, 
+                    # so the page is treated as modified 
+                    self._init_speculative_gets()
                 self.cv.release()
 
         self.tasklist.remove_list(self.fetchlist)
@@ -350,19 +864,34 @@ class PageManager:
         return (status, headers, body, copy(parsed))
 
     def fetch(self, url):
+        """
+        returns the response for the url given, with a copy of 
+        its parsed document, waiting for it to be fetched if 
+        necessary 
+        """
+        status, headers, body, parsed = self._fetch_archived(url)
+        return (status, headers, body, copy(parsed))
+
+    def _fetch_archived(self, url):
         #print "fetch %s" % url
-        self.cv.acquire()
-        try:        
-            if self.have_page_content(url):
-                return self._get_cached_copy(url)
+        with self.cv:
+            if self._have_page_content(url):
+                return self._page_archive[url]
 
             if self._state == PMState.initial: 
                 self._init_speculative_gets()
 
-            should_fetch = self.fetchlist.claim(url)
-        finally:
-            self.cv.release()
+            if (self._deadline is not None and self.fetchlist.registered and 
+                url != self._request_url):
+                # leave the page to the worker threads, so that this 
+                # thread can stop waiting for it at the deadline 
+                self._needed.add(url)
+                self.add_get(url)
+                should_fetch = False
+            else:
+                should_fetch = self.fetchlist.claim(url)
 
+        self.run_overflow()
         if should_fetch:
             self._needed.add(url)
             #get it ourselves
@@ -370,25 +899,125 @@ class PageManager:
                           RequestType.get, 
                           self)
             fetch()
-            self.cv.acquire()
-            try:
-                return self._get_cached_copy(url)
-            finally: 
-                self.cv.release()
 
-        #otherwise, wait for it
-        self.cv.acquire()
-        try:
+        #wait for it, the fetch may complete asynchronously 
+        with self.cv:
             while 1:
-                if self.have_page_content(url): 
-                    return self._get_cached_copy(url)
-                self.cv.wait()
-        finally:
-            self.cv.release()
-    
+                if self._have_page_content(url): 
+                    return self._page_archive[url]
+                if url == self._request_url:
+                    # the page requested has no deadline 
+                    self.cv.wait()
+                elif not self._wait():
+                    self._time_out(url)
+                    return self._page_archive[url]
+
+    def past_deadline(self, url=None):
+        """
+        true if the deadline for the request has passed.  the 
+        page requested itself is always fetched, so this is 
+        false for its url. 
+        """
+        if self._deadline is None or url == self._request_url:
+            return False
+        if time.time() < self._deadline:
+            return False
+        self.deadline_hit = True
+        return True
+
+    def _time_left(self):
+        """
+        the number of seconds until the deadline for the request, 
+        or None if it has none 
+        """
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - time.time())
+
+    def _wait(self):
+        """
+        waits to be notified of a fetch completing, or until the 
+        deadline for the request.  returns False without waiting 
+        once the deadline has passed. 
+        """
+        if self._deadline is None:
+            self.cv.wait()
+            return True
+
+        remaining = self._deadline - time.time()
+        if remaining <= 0:
+            self.deadline_hit = True
+            return False
+        self.cv.wait(remaining)
+        return True
+
+    @locked
+    def _time_out(self, url):
+        """
+        gives up waiting for the page at the url given, archiving 
+        a 504 response in its place.  the response, if it arrives, 
+        is ignored. 
+        """
+        self.timed_out.add(url)
+        self._page_archive[url] = (TIMEOUT_STATUS, [], TIMEOUT_MESSAGE, None)
+        if url in self._needed:
+            self._got_needed(url)
+
+    def content_digest(self, url, levels): 
+        """
+        returns a digest of the page at the url given and of the 
+        pages it includes, down to the number of levels given, 
+        fetching them as necessary.  returns None if any of them 
+        is not a successful html response. 
+        """
+        key = (url, levels)
+        if key in self._digests: 
+            return self._digests[key]
+
+        status, headers, body, parsed = self._fetch_archived(url)
+        if not status.startswith('200') or parsed is None: 
+            return None
+
+        if isinstance(body, unicode): 
+            body = body.encode('utf-8')
+        digest = sha1(body)
+        if levels > 0: 
+            for dep in sorted(self._speculative_dep_info.get(url, [])): 
+                dep_digest = self.content_digest(dep, levels - 1)
+                if dep_digest is None: 
+                    return None
+                digest.update('\0%s\0%s' % (dep, dep_digest))
+
+        digest = self._digests[key] = digest.hexdigest()
+        return digest
 
-    @locked 
     def merge_headers_into(self, headers):        
+        self._finish_pages()
+        with self._lock:
+            self._merge_headers_into(headers)
+
+    def _finish_pages(self):
+        """
+        waits for the pages which are still needed.  pages 
+        needed for their headers alone, such as those included 
+        too deep to be transcluded, may still be queued or in 
+        progress. 
+        """
+        while 1:
+            self.run_overflow()
+            with self.cv:
+                if self._state != PMState.get_pages:
+                    return
+                task = self.fetchlist.pop()
+                if task is None:
+                    if not self._wait():
+                        for url in list(self._needed):
+                            self._time_out(url)
+                        return
+                    continue
+            task()
+
+    def _merge_headers_into(self, headers):
         if not (self._state == PMState.done or self._state == PMState.not_modified):
             print "Bad state %s" % self._state
             print "actual deps", self._actual_deps
@@ -413,23 +1042,135 @@ class PageManager:
 
     @locked
     def add_conditional_get(self, url): 
-        if not self.have_archive(url): 
-            self.fetchlist.push(FetchListItem(url, self._environ, 
-                                              RequestType.conditional_get, 
-                                              self))
+        if not self._have_archive(url): 
+            self._queue(FetchListItem(url, self._environ, 
+                                      RequestType.conditional_get, 
+                                      self))
         
 
     @locked 
     def add_get(self, url): 
-        if not self.have_page_content(url): 
-            self.fetchlist.push(FetchListItem(url, self._environ, 
-                                              RequestType.get, 
-                                              self))
+        if self._have_page_content(url): 
+            return
+        if url in self._validated:
+            # the page need not be fetched again 
+            self._got_page(url, self._validated.pop(url))
+            return
+        self._queue(FetchListItem(url, self._environ, 
+                                  RequestType.get, 
+                                  self))
+
+    @locked
+    def _queue(self, task):
+        """
+        puts the task given on the fetch list, or if the task 
+        list is full, deals with it according to the overflow 
+        policy of the task list.  the page requested itself is 
+        always queued. 
+
+        no task is run here, as the page manager is locked: one 
+        which is to be failed or fetched inline is left for 
+        run_overflow, and one which the thread serving the page 
+        is to wait to queue is left for it in _blocked. 
+        """
+        bounded = task.url != self._request_url
+        try:
+            self.fetchlist.push(task, bounded)
+            return
+        except QueueFull:
+            pass
+
+        overflow = self.tasklist.overflow
+        own_thread = threading.currentThread() is self._thread
+        in_worker = isinstance(threading.currentThread(), WorkerThread)
+
+        if overflow == 'fail':
+            if self.fetchlist.claim(task.url):
+                self._overflow.append(lambda: task.fail(
+                        '503 Service Unavailable', 
+                        "the transcluder fetch queue is full"))
+        elif overflow == 'block' and own_thread:
+            self._blocked.append(task)
+        elif own_thread or in_worker:
+            # a worker thread must not wait for other workers, 
+            # so it blocks by fetching the page itself 
+            if self.fetchlist.claim(task.url):
+                self._overflow.append(task)
+        else:
+            # any other thread, such as that of a fetch engine, 
+            # can neither wait nor fetch 
+            self.fetchlist.push(task, False)
+
+    def run_overflow(self):
+        """
+        runs the tasks which _queue could not put on the fetch 
+        list.  called, without the page manager locked, by the 
+        thread which wanted them queued once it is done with the 
+        response or request that led to them. 
+
+        the thread serving the page also queues the tasks left 
+        in _blocked, waiting for room in the task list and 
+        working through the page's own tasks meanwhile, as its 
+        fetch list may be the one holding up the queue. 
+        """
+        own_thread = threading.currentThread() is self._thread
+        while 1:
+            with self._lock:
+                if self._overflow:
+                    run = self._overflow.popleft()
+                elif own_thread and self._blocked:
+                    run = self._unblock()
+                else:
+                    return
+            if run is not None:
+                run()
+
+    def _unblock(self):
+        """
+        queues the first task in _blocked if there is room, or 
+        returns what the thread serving the page should do in 
+        the meantime 
+        """
+        task = self._blocked[0]
+        if not self._still_wanted(task):
+            self._blocked.popleft()
+            return None
+        try:
+            self.fetchlist.push(task)
+            self._blocked.popleft()
+            return None
+        except QueueFull:
+            pass
+
+        if self.past_deadline(task.url):
+            self._blocked.popleft()
+            if self.fetchlist.claim(task.url):
+                return lambda: task.fail(TIMEOUT_STATUS, TIMEOUT_MESSAGE)
+            return None
+
+        own_task = self.fetchlist.pop()
+        if own_task is not None:
+            return own_task
+        time_left = self._time_left()
+        return lambda: self.tasklist.wait_for_room(time_left)
+
+    def _still_wanted(self, task):
+        if task.request_type == RequestType.get:
+            return not self._have_page_content(task.url)
+        return (self._state == PMState.check_modification and 
+                not self._have_archive(task.url))
            
     @locked
     def got_304(self, task):
+        if task.url in self.timed_out:
+            self._got_late(task)
+            return
+
         assert task.url not in self._page_archive
         self._page_archive[task.url] = task.archive_info() 
+        kept = task.kept_copy()
+        if kept is not None:
+            self._validated[task.url] = kept
 
         self.fetchlist.completed(task)
 
@@ -457,34 +1198,46 @@ class PageManager:
     def notify(self):
         self.cv.notifyAll()
         
+    def _got_late(self, task):
+        self.fetchlist.completed(task)
+        self.notify()
+
     @locked 
     def got_non_redirect(self, task): 
-        self._page_archive[task.url] = task.archive_info() 
-        
+        if task.url in self.timed_out:
+            self._got_late(task)
+            return
+
+        if task.synthetic and task.response[0] == TIMEOUT_STATUS:
+            self.timed_out.add(task.url)
+        self._got_page(task.url, task.archive_info(), task.synthetic)
+
+        self.fetchlist.completed(task)
+
+        self.notify()
+
+    def _got_page(self, url, response, synthetic=False):
+        self._page_archive[url] = response 
+
         # update dependencies 
-        status, headers, body, parsed = task.archive_info() 
-        resource = make_resource_key(task.url, task.environ)
+        status, headers, body, parsed = response
         if parsed is not None:
-            dep_list = self.find_dependencies(parsed, task.url)
+            dep_list = self.find_dependencies(parsed, url)
         else:
             dep_list = []
-        resource = make_resource_key(task.url, self._environ)
-        self.deptracker.set_direct_deps(resource, dep_list)
+        if not synthetic:
+            self.deptracker.set_direct_deps(self._resource_key(url), dep_list)
 
         if self._state == PMState.check_modification: 
             self._init_speculative_gets()            
 
-        self._speculative_dep_info[task.url] = dep_list
+        self._speculative_dep_info[url] = dep_list
 
         for dep in dep_list:
             self.add_get(dep)
 
-        if task.url in self._needed: 
-            self._got_needed(task.url) 
-
-        self.fetchlist.completed(task)
-
-        self.notify()
+        if url in self._needed: 
+            self._got_needed(url) 
 
     def _got_needed(self, url): 
         assert url in self._needed 
@@ -494,7 +1247,7 @@ class PageManager:
 
         all_deps = self.get_all_deps(url)
         for dep in all_deps: 
-            if not self.have_page_content(dep):
+            if not self._have_page_content(dep):
                 self._needed.add(dep)
             else: 
                 self._actual_deps.add(dep)
@@ -503,30 +1256,31 @@ class PageManager:
         if len(self._needed) == 0:
             self._state = PMState.done
             self.tasklist.remove_list(self.fetchlist)
+            # anything left was fetched speculatively and is no 
+            # longer needed 
+            self.fetchlist.clear()
 
 
 
     @locked
     def have_page_content(self, url): 
-
-        self.cv.acquire() 
-        try: 
-            return url in self._page_archive and not self._page_archive[url][0].startswith('304')
-        finally: 
-            self.cv.release()
+        return self._have_page_content(url)
 
     @locked
     def have_archive(self, url): 
-        self.cv.acquire() 
-        try: 
-            return url in self._page_archive
-        finally: 
-            self.cv.release()
+        return self._have_archive(url)
+
+    # for callers which hold the lock already 
+    def _have_page_content(self, url): 
+        return url in self._page_archive and not self._page_archive[url][0].startswith('304')
+
+    def _have_archive(self, url): 
+        return url in self._page_archive
 
     @locked 
     def get_all_deps(self, url): 
-        seen = Set() 
         deps = self._speculative_dep_info.get(url, [])[:]
+        seen = Set(deps) 
         index = 0
         while index < len(deps): 
             new_deps = self._speculative_dep_info.get(deps[index], [])
@@ -563,14 +1317,16 @@ class PageManager:
                self._state == PMState.check_modification)
 
         self._state = PMState.modified
-        self.fetchlist.remove_if_mods()
+        # the conditional gets still queued fetch the pages instead 
+        self.fetchlist.convert_conditional_gets()
 
         self._speculative_dep_info = {} 
         
         self._needed = Set([self._request_url]) 
 
         self.add_get(self._request_url)        
-        urls = self.deptracker.get_all_deps(self._root_resource)
+        urls = self.deptracker.get_all_deps(self._root_resource, 
+                                            self._resource_key)
         for url in urls: 
             self.add_get(url)
 
@@ -0,0 +1,179 @@
+
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+import os
+import shutil
+import tempfile
+from paste.fixture import TestApp
+from paste.response import header_value
+from transcluder.deptracker import DependencyTracker, LRUDependencyTracker, ShardedDependencyTracker, SqliteDependencyTracker
+from transcluder.middleware import TranscluderMiddleware
+from transcluder.fixtures import make_304_app
+
+def check_tracker(tracker):
+    index = ('http://localhost/index.html', '')
+    tracker.set_direct_deps(index, ['http://localhost/a.html', 'http://localhost/b.html'])
+    assert tracker.is_tracked(index)
+    assert not tracker.is_tracked(('http://localhost/a.html', ''))
+    assert tracker.get_direct_deps(index) == ['http://localhost/a.html', 'http://localhost/b.html']
+    assert tracker.get_direct_deps(('http://localhost/a.html', '')) == []
+    assert len(tracker) == 1
+
+    tracker.update({index: [], ('http://localhost/a.html', 'session=1'): ['http://localhost/b.html']})
+    assert tracker.get_direct_deps(index) == []
+    assert tracker.get_direct_deps(('http://localhost/a.html', 'session=1')) == ['http://localhost/b.html']
+    assert len(tracker) == 2
+
+    tracker.clear()
+    assert len(tracker) == 0
+    assert not tracker.is_tracked(index)
+
+def test_trackers():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for tracker in (DependencyTracker(), LRUDependencyTracker(10),
+                        ShardedDependencyTracker(4),
+                        SqliteDependencyTracker(os.path.join(tmpdir, 'deps.db'))):
+            yield check_tracker, tracker
+    finally:
+        shutil.rmtree(tmpdir)
+
+def check_all_deps(tracker):
+    # a diamond: both a and b include c 
+    tracker.set_direct_deps(('index', ''), ['a', 'b'])
+    tracker.set_direct_deps(('a', ''), ['c'])
+    tracker.set_direct_deps(('b', ''), ['c', 'd'])
+    assert tracker.get_all_deps(('index', '')) == ['a', 'b', 'c', 'd']
+
+    # a cycle back to the page itself 
+    tracker.set_direct_deps(('c', ''), ['index'])
+    assert tracker.get_all_deps(('index', '')) == ['a', 'b', 'c', 'd', 'index']
+    assert tracker.get_all_deps(('c', '')) == ['index', 'a', 'b', 'c', 'd']
+
+    # a changed page changes the pages including it 
+    tracker.set_direct_deps(('a', ''), ['e'])
+    tracker.set_direct_deps(('c', ''), [])
+    assert tracker.get_all_deps(('index', '')) == ['a', 'b', 'e', 'c', 'd']
+    assert tracker.get_all_deps(('c', '')) == []
+
+    # the dependencies of included pages are looked up by key_for 
+    tracker.set_direct_deps(('e', 'lang=fr'), ['f'])
+    assert tracker.get_all_deps(('index', ''), lambda url: (url, 'lang=fr')) == ['a', 'b']
+    assert tracker.get_all_deps(('index', '')) == ['a', 'b', 'e', 'c', 'd']
+    tracker.set_direct_deps(('a', 'lang=fr'), ['e'])
+    assert tracker.get_all_deps(('index', ''), lambda url: (url, 'lang=fr')) == ['a', 'b', 'e', 'f']
+
+def test_all_deps():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for tracker in (DependencyTracker(), LRUDependencyTracker(10),
+                        ShardedDependencyTracker(4),
+                        SqliteDependencyTracker(os.path.join(tmpdir, 'deps.db'))):
+            yield check_all_deps, tracker
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_all_deps_evicted():
+    tracker = LRUDependencyTracker(3)
+    tracker.set_direct_deps(('index', ''), ['a'])
+    tracker.set_direct_deps(('a', ''), ['b'])
+    assert tracker.get_all_deps(('index', '')) == ['a', 'b']
+    assert tracker.is_tracked(('index', ''))
+    tracker.set_direct_deps(('x', ''), [])
+    tracker.set_direct_deps(('y', ''), [])
+    assert not tracker.is_tracked(('a', ''))
+    assert tracker.get_all_deps(('index', '')) == ['a']
+
+def test_nested_304():
+    pages = {'/index.html' : ['/a.html'], '/a.html' : ['/b.html'], '/b.html' : []}
+    etags = {'/index.html' : 'index', '/a.html' : 'a', '/b.html' : 'b'}
+    def app(environ, start_response):
+        path = environ['PATH_INFO']
+        if environ.get('HTTP_IF_NONE_MATCH') == etags[path]:
+            start_response('304 Not Modified', [('ETag', etags[path])])
+            return []
+        start_response('200 OK', [('Content-Type', 'text/html'), ('ETag', etags[path])])
+        links = ''.join(['<a rel="include" href="%s"></a>' % dep for dep in pages[path]])
+        return ['<html><body><p>%s</p>%s</body></html>' % (etags[path], links)]
+
+    test_app = TestApp(TranscluderMiddleware(app))
+    etag = header_value(test_app.get('/index.html').headers, 'ETAG')
+    result = test_app.get('/index.html', extra_environ={'HTTP_IF_NONE_MATCH' : etag})
+    assert result.status == 304
+
+    # a change to a page included by an included page is noticed 
+    etags['/b.html'] = 'b.new'
+    result = test_app.get('/index.html', extra_environ={'HTTP_IF_NONE_MATCH' : etag})
+    assert result.status == 200
+    assert '<p>b.new</p>' in result.body
+
+def test_lru_tracker():
+    tracker = LRUDependencyTracker(2)
+    tracker.set_direct_deps(('a', ''), ['x'])
+    tracker.set_direct_deps(('b', ''), ['y'])
+    assert tracker.is_tracked(('a', ''))
+    tracker.set_direct_deps(('c', ''), ['z'])
+
+    assert len(tracker) == 2
+    assert tracker.evictions == 1
+    assert tracker.is_tracked(('a', ''))
+    assert not tracker.is_tracked(('b', ''))
+    assert tracker.is_tracked(('c', ''))
+
+def test_sqlite_tracker_bound():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tracker = SqliteDependencyTracker(os.path.join(tmpdir, 'deps.db'), max_entries=50)
+        for i in range(200):
+            tracker.set_direct_deps(('page%s' % i, ''), ['x'])
+        assert len(tracker) <= 50
+        assert tracker.is_tracked(('page199', ''))
+        assert not tracker.is_tracked(('page0', ''))
+
+        # rewriting a tracked resource does not add a row 
+        tracker.set_direct_deps(('page199', ''), ['y'])
+        assert tracker.get_direct_deps(('page199', '')) == ['y']
+        assert len(tracker) == 50
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_sqlite_tracker_survives_restart():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'deps.db')
+
+        cache_app, pages = make_304_app()
+
+        test_app = TestApp(TranscluderMiddleware(cache_app, deptracker=SqliteDependencyTracker(path)))
+        result = test_app.get('/index.html')
+        etag = header_value(result.headers, 'ETAG')
+
+        # a new process reading the same file can answer with a 304 at once
+        test_app = TestApp(TranscluderMiddleware(cache_app, deptracker=SqliteDependencyTracker(path)))
+        result = test_app.get('/index.html', extra_environ={'HTTP_IF_NONE_MATCH' : etag})
+        assert result.status == 304
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_vary_cookies():
+    cache_app, pages = make_304_app()
+
+    tracker = DependencyTracker()
+    test_app = TestApp(TranscluderMiddleware(cache_app, deptracker=tracker,
+                                             vary_cookies=['lang']))
+    result = test_app.get('/index.html', extra_environ={'HTTP_COOKIE' : 'session=1; lang=en'})
+    etag = header_value(result.headers, 'ETAG')
+    assert len(tracker) == 3
+
+    # a different session shares the graph recorded for the first one
+    result = test_app.get('/index.html', extra_environ={'HTTP_COOKIE' : 'session=2; lang=en',
+                                                        'HTTP_IF_NONE_MATCH' : etag})
+    assert result.status == 304
+    assert len(tracker) == 3
+
+    # but a cookie named in vary_cookies gets a graph of its own
+    test_app.get('/index.html', extra_environ={'HTTP_COOKIE' : 'session=1; lang=fr'})
+    assert len(tracker) == 6
@@ -0,0 +1,173 @@
+
+# Copyright (c) 2007 The Open Planning Project.
+
+# Transcluder is Free Software.  See license.txt for licensing terms
+
+
+import time
+from threading import Thread, currentThread
+from paste.fixture import TestApp
+from transcluder.middleware import TranscluderMiddleware
+from transcluder.tasklist import TaskList, FetchList, FetchListItem, RequestType, SingleFlight
+
+def include_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/html')])
+    if environ['PATH_INFO'] == '/index.html':
+        return ['<html><body>'
+                '<a rel="include" href="/a.html"></a>'
+                '<a rel="include" href="/b.html"></a>'
+                '<a rel="include" href="/c.html"></a>'
+                '</body></html>']
+    return ['<html><body><p>page %s</p></body></html>' % environ['PATH_INFO'][1:2]]
+
+def get_with_overflow(overflow):
+    # without worker threads only one include fits in the queue
+    tasklist = TaskList(poolsize=0, max_queued=1, overflow=overflow)
+    test_app = TestApp(TranscluderMiddleware(include_app, tasklist=tasklist))
+    body = test_app.get('/index.html').body
+    assert tasklist.queued == 0
+    return body
+
+def test_overflow_fail():
+    body = get_with_overflow('fail')
+    assert body.count('<p>page') == 1
+    assert body.count('Status was: 503') == 2
+
+def test_overflow_inline():
+    body = get_with_overflow('inline')
+    assert 'page a' in body and 'page b' in body and 'page c' in body
+
+def test_overflow_block():
+    body = get_with_overflow('block')
+    assert 'page a' in body and 'page b' in body and 'page c' in body
+
+def test_origin_limit():
+    tasklist = TaskList(poolsize=0, max_per_origin=1)
+    fetchlist = FetchList(tasklist)
+    for url in ('http://a.com/1', 'http://a.com:80/2', 'http://b.com/1'):
+        fetchlist.push(FetchListItem(url, {}, RequestType.get, None))
+    tasklist.put_list(fetchlist)
+
+    first = tasklist.get()
+    assert first.url == 'http://a.com/1'
+    # a.com is busy, so its second page waits for the first
+    assert tasklist.get().url == 'http://b.com/1'
+    tasklist.finished(first)
+    assert tasklist.get().url == 'http://a.com:80/2'
+    assert tasklist.queued == 0
+
+def test_include_timeout():
+    # the threads which checked pages for changes 
+    checked_on = []
+    def app(environ, start_response):
+        if 'HTTP_IF_NONE_MATCH' in environ:
+            checked_on.append(currentThread())
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        if environ['PATH_INFO'] == '/index.html':
+            return ['<html><body>'
+                    '<a rel="include" href="/fast.html"></a>'
+                    '<a rel="include" href="/slow.html"></a>'
+                    '</body></html>']
+        if environ['PATH_INFO'] == '/slow.html':
+            time.sleep(1)
+        return ['<html><body><p>%s</p></body></html>' % environ['PATH_INFO']]
+
+    transcluder = TranscluderMiddleware(app, include_timeout=0.3)
+    test_app = TestApp(transcluder)
+    start = time.time()
+    body = test_app.get('/index.html').body
+    assert time.time() - start < 0.9
+    assert '<p>/fast.html</p>' in body
+    assert 'Status was: 504' in body
+    assert transcluder.deadline_hits == 1
+    assert transcluder.timed_out_pages == 1
+
+    # checking whether the pages changed is cut off as well, 
+    # so the checks are left to the worker threads 
+    start = time.time()
+    body = test_app.get('/index.html', 
+                        extra_environ={'HTTP_IF_NONE_MATCH' : '"old"'}).body
+    assert time.time() - start < 0.9
+    assert '<p>/fast.html</p>' in body
+    assert transcluder.deadline_hits == 2
+    assert checked_on
+    assert currentThread() not in checked_on
+
+def test_slow_root_page():
+    # the page requested is waited for past the deadline 
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        if environ['PATH_INFO'] == '/index.html':
+            time.sleep(0.5)
+            return ['<html><body><a rel="include" href="/fast.html"></a></body></html>']
+        return ['<html><body><p>%s</p></body></html>' % environ['PATH_INFO']]
+
+    transcluder = TranscluderMiddleware(app, include_timeout=0.2)
+    result = TestApp(transcluder).get('/index.html')
+    assert result.status == 200
+    assert result.header('content-type').startswith('text/html')
+    # by then the includes are out of time 
+    assert 'Status was: 504' in result.body
+
+def test_single_flight():
+    fetches = []
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        if environ['PATH_INFO'] == '/index.html':
+            return ['<html><body><a rel="include" href="/nav.html"></a></body></html>']
+        fetches.append(environ['PATH_INFO'])
+        time.sleep(0.3)
+        return ['<html><body><p>nav</p></body></html>']
+
+    transcluder = TranscluderMiddleware(app, single_flight=SingleFlight())
+    test_app = TestApp(transcluder)
+    bodies = []
+    def get():
+        bodies.append(test_app.get('/index.html').body)
+    threads = [Thread(target=get) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every page got the include from the one fetch
+    assert len(bodies) == 5
+    for body in bodies:
+        assert '<p>nav</p>' in body
+    assert fetches == ['/nav.html']
+    assert transcluder.single_flight.shared >= 4
+
+def test_single_flight_cookies():
+    fetches = []
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/index.html':
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            return ['<html><body><a rel="include" href="/nav.html"></a></body></html>']
+        session = environ['HTTP_COOKIE'].split('=')[1]
+        fetches.append(session)
+        time.sleep(0.3)
+        start_response('200 OK', [('Content-Type', 'text/html'), 
+                                  ('Set-Cookie', 'seen=%s' % session)])
+        return ['<html><body><p>nav</p></body></html>']
+
+    transcluder = TranscluderMiddleware(app, single_flight=SingleFlight())
+    test_app = TestApp(transcluder)
+    cookies = []
+    def get(session):
+        result = test_app.get('/index.html', 
+                              extra_environ={'HTTP_COOKIE' : 'session=%s' % session})
+        cookies.append((session, [value for name, value in result.headers 
+                                  if name.lower() == 'set-cookie']))
+    sessions = ['1', '2', '3', 'same', 'same']
+    threads = [Thread(target=get, args=(session,)) for session in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # no page is given the cookies set for another, and a response 
+    # setting cookies is not shared even within a session 
+    assert len(cookies) == 5
+    for session, values in cookies:
+        assert values == ['seen=%s' % session], values
+    assert sorted(fetches) == sorted(sessions)
@@ -11,6 +11,7 @@
 import re
 import os
 import sys
+import socket
 import time
 from lxml import etree
 from paste.fixture import TestApp
@@ -19,11 +20,17 @@ from paste.response import header_value
 from paste.request import construct_url
 from paste.wsgilib import intercept_output
 from paste import httpheaders
-from transcluder.middleware import TranscluderMiddleware
+from webob import Request
+from transcluder.middleware import TranscluderMiddleware, ResponseParser
 from transcluder.tasklist import TaskList
+from transcluder.fetchengine import FetchEngine
+from transcluder.connpool import ConnectionPool
+from transcluder.cache import LRUCache, StalePolicy
 from formencode.doctest_xml_compare import xml_compare
 from wsgifilter.fixtures.cache_fixture import CacheFixtureApp, CacheFixtureResponseInfo
+from transcluder.fixtures import make_304_app
 import traceback 
+from threading import Thread, Event, currentThread
 
 """
 this runs tests in the test-data directory. 
@@ -140,6 +147,277 @@ def test_etag_304():
     result = test_app.get('/index.html', extra_environ={'HTTP_IF_NONE_MATCH' : new_etag})
     assert result.status == 304 
 
+def test_modified_revalidation():
+    cache_app, pages = make_304_app()
+
+    sent = []
+    def app(environ, start_response):
+        def counting_start_response(status, headers, exc_info=None):
+            sent.append((environ['PATH_INFO'], status[:3]))
+            return start_response(status, headers, exc_info)
+        return cache_app(environ, counting_start_response)
+
+    test_app = TestApp(TranscluderMiddleware(app))
+    etag = header_value(test_app.get('/index.html').headers, 'ETAG')
+
+    # once one page turns out to have changed, the others are taken 
+    # from the page cache rather than requested a second time 
+    pages['page1.html'].data = pages['page1.html'].data.replace('April', 'August')
+    pages['page1.html'].etag = 'page1.new'
+    del sent[:]
+    result = test_app.get('/index.html', extra_environ={'HTTP_IF_NONE_MATCH' : etag})
+    assert result.status == 200
+    assert 'August' in result.body
+    assert sorted(sent) == [('/index.html', '304'), ('/page1.html', '200'), 
+                            ('/page2.html', '304')]
+
+
+def test_page_cache():
+    cache_app, pages = make_304_app()
+    page1 = pages['page1.html']
+
+    transcluder = TranscluderMiddleware(cache_app)
+    test_app = TestApp(transcluder)
+
+    first = test_app.get('/index.html')
+    assert transcluder.page_cache.hits == 0
+    assert len(transcluder.page_cache) == 3
+
+    # every page is revalidated and reused
+    second = test_app.get('/index.html')
+    assert transcluder.page_cache.hits == 3
+    html_string_compare(second.body, first.body)
+
+    # a changed page is fetched again
+    page1.data = page1.data.replace('April', 'August')
+    page1.etag = 'page1.new'
+    third = test_app.get('/index.html')
+    assert 'August' in third.body
+    assert transcluder.page_cache.hits == 6
+    assert header_value(third.headers, 'ETAG') != header_value(first.headers, 'ETAG')
+
+def test_stale_policy():
+    fragment = {'text' : 'first', 'status' : '200 OK', 'fetches' : 0}
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/index.html':
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            return ['<html><body><a rel="include" href="/frag.html"></a></body></html>']
+        fragment['fetches'] += 1
+        start_response(fragment['status'],
+                       [('Content-Type', 'text/html'),
+                        ('ETag', '"%s"' % fragment['text']),
+                        ('Cache-Control', 'max-age=0, stale-if-error=60')])
+        return ['<html><body><p>%s</p></body></html>' % fragment['text']]
+
+    transcluder = TranscluderMiddleware(app, stale_policy=StalePolicy(stale_while_revalidate=60))
+    test_app = TestApp(transcluder)
+    assert '<p>first</p>' in test_app.get('/index.html').body
+    assert fragment['fetches'] == 1
+
+    # the stale copy is used at once, and refetched in the background
+    fragment['text'] = 'second'
+    assert '<p>first</p>' in test_app.get('/index.html').body
+    for i in range(100):
+        time.sleep(0.01)
+        body = test_app.get('/index.html').body
+        if '<p>first</p>' not in body:
+            break
+    assert '<p>second</p>' in body
+
+    # an error is hidden while the copy is within stale-if-error
+    transcluder.stale_policy = StalePolicy()
+    fragment['status'] = '503 Service Unavailable'
+    fragment['text'] = 'third'
+    assert '<p>second</p>' in test_app.get('/index.html').body
+
+def test_stale_policy_private():
+    # a page private to one user is not kept for another 
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/index.html':
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            return ['<html><body><a rel="include" href="/account.html"></a></body></html>']
+        start_response('200 OK', 
+                       [('Content-Type', 'text/html'),
+                        ('ETag', '"account"'),
+                        ('Cache-Control', 'private, max-age=60')])
+        return ['<html><body><p>account of %s</p></body></html>' % environ['HTTP_AUTHORIZATION']]
+
+    transcluder = TranscluderMiddleware(app, stale_policy=StalePolicy(stale_while_revalidate=60))
+    test_app = TestApp(transcluder)
+    alice = test_app.get('/index.html', extra_environ={'HTTP_AUTHORIZATION' : 'Basic alice'})
+    assert '<p>account of Basic alice</p>' in alice.body
+    bob = test_app.get('/index.html', extra_environ={'HTTP_AUTHORIZATION' : 'Basic bob'})
+    assert '<p>account of Basic bob</p>' in bob.body
+    assert len(transcluder.page_cache) == 0
+
+
+def test_rendered_cache():
+    cache_app, pages = make_304_app()
+
+    transcluder = TranscluderMiddleware(cache_app)
+    test_app = TestApp(transcluder)
+
+    first = test_app.get('/index.html')
+    assert len(transcluder.rendered_cache) == 2
+    assert transcluder.rendered_cache.hits == 0
+
+    # unchanged pages are included without being transcluded again
+    second = test_app.get('/index.html')
+    assert transcluder.rendered_cache.hits == 2
+    html_string_compare(second.body, first.body)
+
+    # a changed page is not
+    pages['page1.html'].data = pages['page1.html'].data.replace('April', 'August')
+    pages['page1.html'].etag = 'page1.new'
+    third = test_app.get('/index.html')
+    assert 'August' in third.body
+    assert transcluder.rendered_cache.hits == 3
+
+
+def test_output_cache():
+    cache_app, pages = make_304_app()
+
+    sent = []
+    def app(environ, start_response):
+        def counting_start_response(status, headers, exc_info=None):
+            sent.append(status)
+            return start_response(status, headers, exc_info)
+        return cache_app(environ, counting_start_response)
+
+    transcluder = TranscluderMiddleware(app, output_cache=LRUCache())
+    test_app = TestApp(transcluder)
+
+    first = test_app.get('/index.html')
+    assert len(transcluder.output_cache) == 1
+
+    # the pages are only revalidated, and the page kept is sent 
+    del sent[:]
+    second = test_app.get('/index.html')
+    assert transcluder.output_cache.hits == 1
+    assert [status[:3] for status in sent] == ['304'] * 3
+    assert second.body == first.body
+    assert header_value(second.headers, 'ETAG') == header_value(first.headers, 'ETAG')
+
+    # a changed page is transcluded again
+    pages['page1.html'].data = pages['page1.html'].data.replace('April', 'August')
+    pages['page1.html'].etag = 'page1.new'
+    third = test_app.get('/index.html')
+    assert 'August' in third.body
+    fourth = test_app.get('/index.html')
+    assert fourth.body == third.body
+    assert transcluder.output_cache.hits == 3
+
+
+def test_output_cache_sessions():
+    # the greeting is personalised, but its etag is not 
+    def app(environ, start_response):
+        etag = '"%s"' % environ['PATH_INFO']
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            start_response('304 Not Modified', [('ETag', etag)])
+            return []
+        headers = [('Content-Type', 'text/html'), ('ETag', etag)]
+        if environ['PATH_INFO'] == '/index.html':
+            body = '<html><body><a rel="include" href="/greeting.html"></a></body></html>'
+        else:
+            user = environ.get('HTTP_AUTHORIZATION', environ.get('HTTP_COOKIE'))
+            body = '<html><body><p>hello %s</p></body></html>' % user
+            if 'private' in user:
+                headers.append(('Cache-Control', 'private'))
+        start_response('200 OK', headers)
+        return [body]
+
+    transcluder = TranscluderMiddleware(app, output_cache=LRUCache(), 
+                                        vary_cookies=['lang'])
+    test_app = TestApp(transcluder)
+    first = test_app.get('/index.html', extra_environ={'HTTP_COOKIE' : 'session=1'})
+    assert 'hello session=1' in first.body
+
+    # a page kept for one session is not sent to another 
+    second = test_app.get('/index.html', extra_environ={'HTTP_COOKIE' : 'session=2'})
+    assert 'hello session=2' in second.body
+    assert len(transcluder.output_cache) == 2
+
+    # nor is a page made with one user's credentials sent to another 
+    alice = test_app.get('/index.html', extra_environ={'HTTP_AUTHORIZATION' : 'Basic alice'})
+    assert 'hello Basic alice' in alice.body
+    bob = test_app.get('/index.html', extra_environ={'HTTP_AUTHORIZATION' : 'Basic bob'})
+    assert 'hello Basic bob' in bob.body
+
+    # and a page including a private one is not kept 
+    test_app.get('/index.html', extra_environ={'HTTP_COOKIE' : 'session=private'})
+    assert len(transcluder.output_cache) == 2
+
+
+def test_decoded_include():
+    # bodies of responses with a charset are decoded before they 
+    # are archived 
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+        if environ['PATH_INFO'] == '/index.html':
+            return ['<html><body><a href="/sub.html" rel="include">x</a></body></html>']
+        return ['<html><body>caf\xc3\xa9</body></html>']
+
+    test_app = TestApp(TranscluderMiddleware(app))
+    for i in range(2):
+        result = test_app.get('/index.html')
+        html_string_compare(result.body, '<html><body>caf\xc3\xa9</body></html>')
+
+
+def test_sniff_limit():
+    headers = [('Content-Type', 'text/html')]
+    preamble = '<!-- %s -->' % ('x' * 5000)
+
+    transcluder = TranscluderMiddleware(None)
+    assert transcluder.is_html('200 OK', headers, '<HTML><body>hi</body></HTML>')
+    assert transcluder.is_html('200 OK', headers, '<!DOCTYPE html>\n< html lang="en">')
+    assert not transcluder.is_html('200 OK', headers, '<p>a fragment</p>')
+    assert not transcluder.is_html('200 OK', [('Content-Type', 'text/plain')], '<html>')
+    assert not transcluder.is_html('200 OK', headers, preamble + '<html></html>')
+
+    transcluder = TranscluderMiddleware(None, sniff_limit=None)
+    assert transcluder.is_html('200 OK', headers, preamble + '<html></html>')
+
+def test_incremental_feed():
+    # parsing starts once an html tag and a link have arrived, 
+    # without waiting for sniff_limit bytes 
+    headers = [('Content-Type', 'text/html')]
+    for sniff_limit in (None, 4096):
+        transcluder = TranscluderMiddleware(None, sniff_limit=sniff_limit)
+        parser = ResponseParser(transcluder, '200 OK', headers)
+        parser.feed('<html><body><p>a</p>')
+        assert not parser._feeding
+        parser.feed('<a rel="include" href="/a.html">a</a>')
+        assert parser._feeding
+        parser.feed('</body></html>')
+        status, headers, body, parsed = parser.close()
+        assert len(parsed.xpath('//a')) == 1
+
+    # a body with no html tag in its first sniff_limit bytes is 
+    # left unparsed 
+    parser = ResponseParser(TranscluderMiddleware(None), '200 OK', headers)
+    parser.feed('<!-- %s -->' % ('x' * 5000))
+    parser.feed('<html><body><a rel="include" href="/a.html">a</a></body></html>')
+    assert parser.close()[3] is None
+
+def test_unparsed_leaf():
+    leaf = '<html><body><p id="x">leaf  <b>page</b></p></body></html>'
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        if environ['PATH_INFO'] == '/leaf.html':
+            return [leaf]
+        return ['<html><body><a rel="include" href="/leaf.html#x"></a></body></html>']
+
+    for options in ({}, {'feed_parser': True}):
+        transcluder = TranscluderMiddleware(app, **options)
+        test_app = TestApp(transcluder)
+
+        # a page without links is passed on as it was
+        result = test_app.get('/leaf.html')
+        assert result.body == leaf
+
+        result = test_app.get('/index.html')
+        html_string_compare(result.body, '<html><body><p id="x">leaf  <b>page</b></p></body></html>')
+
 
 class PausingMiddleware: 
     def __init__(self, app, sleep_time): 
@@ -335,9 +613,167 @@ def test_external():
             continue 
         yield external, os.path.join(test_dir, dir)
 
-def run_dir(dir):
+def test_fetch_engine():
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    versions = []
+    class FragmentHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            versions.append(self.request_version)
+            body = '<html><head></head><body><div id="lamb">lamb</div></body></html>'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), FragmentHandler)
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.setDaemon(1)
+    server_thread.start()
+
+    page = ('<html><head></head><body>Mary had a little '
+            '<a href="http://127.0.0.1:%d/sub.html#lamb" rel="include">blank</a>.'
+            '</body></html>' % server.server_address[1])
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return [page]
+
+    # the threads which looked at page bodies 
+    parsed_on = []
+    class Middleware(TranscluderMiddleware):
+        def may_have_links(self, body):
+            parsed_on.append(currentThread())
+            return TranscluderMiddleware.may_have_links(self, body)
+
+    engine = FetchEngine()
+    try:
+        for feed_parser in (False, True):
+            del versions[:]
+            test_app = TestApp(Middleware(app, fetch_engine=engine,
+                                          feed_parser=feed_parser))
+            result = test_app.get('/index.html')
+            assert '<div id="lamb">lamb</div>' in result.body
+            # fetched by the engine rather than by httplib
+            assert versions == ['HTTP/1.0']
+        # but not parsed on the engine's loop 
+        assert parsed_on
+        assert engine._thread not in parsed_on
+    finally:
+        engine.kill()
+        server.shutdown()
+
+def test_fetch_engine_error():
+    # a failed fetch is reported on a worker thread as well 
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    called = []
+    done = Event()
+    def callback(response, error):
+        called.append((currentThread(), error))
+        done.set()
+
+    engine = FetchEngine()
+    try:
+        transcluder = TranscluderMiddleware(None, fetch_engine=engine)
+        environ = Request.blank('/index.html').environ
+        assert transcluder.etree_subrequest_async('http://127.0.0.1:%d/' % port, 
+                                                  environ, callback)
+        done.wait(10)
+    finally:
+        engine.kill()
+    thread, error = called[0]
+    assert error is not None
+    assert thread is not engine._thread
+
+def test_connection_pool():
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    clients = []
+    class FragmentHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            clients.append(self.client_address)
+            body = '<html><head></head><body><div id="x">%s</div></body></html>' % self.path
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), FragmentHandler)
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.setDaemon(1)
+    server_thread.start()
+
+    page = ('<html><head></head><body>'
+            '<a href="http://127.0.0.1:%d/a.html#x" rel="include">a</a>'
+            '<a href="http://127.0.0.1:%d/b.html#x" rel="include">b</a>'
+            '</body></html>' % (server.server_address[1], server.server_address[1]))
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return [page]
+
+    pool = ConnectionPool(max_per_host=1)
+    try:
+        test_app = TestApp(TranscluderMiddleware(app, connection_pool=pool))
+        for i in range(2):
+            result = test_app.get('/index.html')
+            assert '<div id="x">/a.html</div>' in result.body
+            assert '<div id="x">/b.html</div>' in result.body
+        # all four fetches went over the same connection
+        assert len(clients) == 4
+        assert len(set(clients)) == 1
+        assert pool.created == 1 and pool.reused == 3
+    finally:
+        pool.close()
+        server.shutdown()
+
+def test_connection_pool_deadline():
+    # a fetch waiting for a connection to a busy host gives up at 
+    # the deadline of the request 
+    pool = ConnectionPool(max_per_host=1)
+    # the one connection to the host is in use 
+    pool._open[('http', '127.0.0.1', 1)] = 1
+    environ = Request.blank('/index.html').environ
+    environ['transcluder.deadline'] = time.time() + 0.2
+    start = time.time()
+    try:
+        pool.get_resource('http://127.0.0.1:1/a.html', environ)
+    except socket.timeout:
+        pass
+    else:
+        assert False, "the fetch should have timed out"
+    assert time.time() - start < 1
+
+def test_streaming():
+    base_dir = os.path.dirname(__file__)
+    test_dir = os.path.join(base_dir, 'test-data', 'standard', 'multi_same_doc')
+    static_app = StaticURLParser(test_dir)
+    trans_app = TranscluderMiddleware(static_app, streaming=True)
+
+    result = TestApp(trans_app).get('/index.html')
+    expected = TestApp(static_app).get('/expected.html')
+    html_string_compare(result.body, expected.body)
+    assert header_value(result.headers, 'content-length') is None
+    assert header_value(result.headers, 'etag') is None
+
+    def start_response(status, headers):
+        pass
+    pieces = list(trans_app(Request.blank('/index.html').environ, start_response))
+    assert len(pieces) > 1
+    assert pieces[0].startswith('<!DOCTYPE')
+
+def run_dir(dir, options={}):
     static_app = StaticURLParser(dir)
-    trans_app = TranscluderMiddleware(static_app)
+    trans_app = TranscluderMiddleware(static_app, **options)
     app = TestApp(trans_app)
     expected_app = TestApp(static_app)
     
@@ -353,6 +789,33 @@ def test_internal():
             continue
         yield run_dir, os.path.join(test_dir, dir)
 
+def test_feed_parser():
+    base_dir = os.path.dirname(__file__)
+    test_dir = os.path.join(base_dir, 'test-data', 'standard')
+    for dir in os.listdir(test_dir):
+        if dir.startswith('.'):
+            continue
+        yield run_dir, os.path.join(test_dir, dir), {'feed_parser' : True}
+
+def test_feed_parser_charset():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html; charset=iso-8859-1')])
+        if environ['PATH_INFO'] == '/index.html':
+            return ['<html><body>', '<a href="/sub.html" rel="include">x</a>', '</body></html>']
+        if environ['PATH_INFO'] == '/plain.html':
+            return ['<html><body>caf\xe9</body></html>']
+        return ['<html><bo', 'dy>caf\xe9</body></html>']
+
+    test_app = TestApp(TranscluderMiddleware(app, feed_parser=True))
+    result = test_app.get('/index.html')
+    html_string_compare(result.body, '<html><body>caf\xc3\xa9</body></html>')
+
+    # a page with nothing to include is passed on as it was 
+    result = test_app.get('/plain.html')
+    assert result.body == '<html><body>caf\xe9</body></html>'
+    assert header_value(result.headers, 'content-type') == 'text/html; charset=iso-8859-1'
+
+
 thread_count = 0
 from threading import Thread
 def try_teXst_parallel_gets():
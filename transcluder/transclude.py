@@ -11,9 +11,27 @@ import lxmlutils
 from transcluder import helpers 
 from transcluder import uritemplates
 import traceback 
-from threading import Lock
-from transcluder.locked import locked
+import threading
+import random
 import copy
+import re
+
+
+class _XPaths(threading.local):
+    """
+    compiled xpath expressions used by the transcluder.  an
+    lxml XPath object serializes its own evaluations, so each
+    thread compiles its own set rather than sharing one.
+    """
+    def __init__(self):
+        self.include_links = etree.XPath("//a[@rel='include']")
+        self.element_by_id = etree.XPath("//*[@id=$id]")
+        self.descendant_by_id = etree.XPath("descendant::*[@id=$id]")
+        self.body = etree.XPath("//body")
+        self.body_children = etree.XPath("//body/child::node()")
+        self.placeholders = etree.XPath("descendant::comment()[starts-with(., $prefix)]")
+
+_xpaths = _XPaths()
 
 class Transcluder: 
     """
@@ -35,7 +53,8 @@ class Transcluder:
     def __init__(self, variables, fetch,
                  should_include=helpers.all_urls,
                  should_recurse=helpers.all_urls,
-                 max_depth=3):
+                 max_depth=3, splice=False, rendered_cache=None,
+                 digest=None):
         """
         variables - a dictionary which specifies the
           values to use when filling in uri template
@@ -43,7 +62,8 @@ class Transcluder:
 
         fetch - a function acception a url and
           returning a parsed lxml document representing
-          the content located at the url.
+          the content located at the url, or an 
+          lxmlutils.UnparsedDocument standing for one. 
 
         should_include - a predicate accepting a url
           which returns true iff it is acceptable to
@@ -58,15 +78,44 @@ class Transcluder:
           transclusions performed when transcluding a
           document. Set to 1 to only include documents
           referenced by the document given. 
+
+        splice - if true, included content is not copied into
+          the document. each link is replaced by a placeholder
+          comment instead, and the content is serialized once
+          however many times it is included.  the html of the
+          transcluded document is then the result of passing
+          its serialization through expand_placeholders(). 
+
+        rendered_cache - with splice, an optional cache shared 
+          between transcluders (see transcluder.cache.LRUCache) 
+          which keeps the html included for each link, so that 
+          a page which has not changed is not transcluded, fixed 
+          up and serialized again.  it is only used if digest is 
+          given. 
+
+        digest - a function accepting a url and a number of levels 
+          and returning a string which changes whenever the page 
+          at the url or any page it includes, down to that many 
+          levels, changes.  it may return None to prevent caching 
+          of the page. 
         """
         self.variables = variables 
         self.fetch = fetch
         self.should_include = should_include
         self.should_recurse = should_recurse
         self.max_depth = max_depth
-        self._lock = Lock()
+        self.splice = splice
+        self.rendered_cache = rendered_cache
+        self.digest = digest
+        self._include_index = {}
+        self._joined_urls = {}
+
+        self._placeholder_prefix = 'transcluder-include-%08x-' % random.getrandbits(32)
+        self._placeholder_pat = re.compile('<!--(%s\\d+)-->' % re.escape(self._placeholder_prefix))
+        self._placeholder_ids = {} 
+        self._fragments = {} 
+        self._fragment_sources = {}
 
-    @locked
     def xpath(self, document, path):
         return document.xpath(path)
 
@@ -83,28 +132,33 @@ class Transcluder:
         if _cache is None:
             _cache = {}
 
-        target_links = self.get_transcluder_links(document)
-        if not target_links:
+        includes = self.index_includes(document, document_url)
+        if not includes:
             return False #nothing to transclude
-        for target in target_links:
-            source_url = self.get_include_url(target, document_url) 
-
+        for target, source_url, allowed in includes:
             if source_url is None: 
                 self.attach_warning(target, "no href specified")
                 continue
 
             try:
-                if not self.should_include(source_url):
+                if not allowed:
                     self.attach_warning(target,
                                         "Including from this URL is forbidden")
                     continue
 
+                rendered_key = self._rendered_key(source_url, _depth)
+                if (rendered_key is not None and 
+                    self._merge_rendered(target, rendered_key)): 
+                    continue
+
                 subdoc = self._get(source_url, _depth, _cache)
                 if subdoc is None:
                     self.attach_warning(target, "No HTML content in %s" % source_url)
                     continue
                 else:
                     self.merge(target, subdoc, source_url)
+                    if rendered_key is not None: 
+                        self._remember_rendered(rendered_key, subdoc, source_url)
 
 
             except Exception, message:
@@ -124,6 +178,8 @@ class Transcluder:
             subdoc = self.fetch(base_url)
             if subdoc is None:
                 return None
+            if isinstance(subdoc, lxmlutils.UnparsedDocument):
+                subdoc = subdoc.parse()
 
             should_cache = True
             if depth >= self.max_depth:
@@ -139,7 +195,7 @@ class Transcluder:
                                 _cache=cache,
                                 _depth=depth+1)
 
-            lxmlutils.fixup_links(subdoc, source_url)
+            lxmlutils.fixup_links(subdoc, source_url, self._joined_urls)
                 
             if should_cache:
                 cache[base_url] = subdoc
@@ -157,16 +213,43 @@ class Transcluder:
 
         deps = Set() 
 
-        target_links = self.get_transcluder_links(document)
-        for target in target_links: 
-            source_url = self.get_include_url(target, document_url)
-            if (source_url is not None and
-                self.should_include(source_url)):
+        for target, source_url, allowed in self.index_includes(document, document_url): 
+            if allowed:
                 deps.add(self.base_url(source_url))
 
         return list(deps)
 
 
+    def index_includes(self, document, document_url): 
+        """
+        returns a list of (link, source_url, allowed) for each
+        transcluder link in the document given, where source_url
+        is the expanded and absolute url the link refers to (or
+        None if it has no href) and allowed is the verdict of
+        the should_include policy on it. 
+
+        each href is resolved once per document url: the
+        documents handed to find_dependencies and transclude
+        are separate copies of the same page, so their links
+        are found again but not expanded, joined and checked
+        again. 
+        """
+        base_url = self.base_url(document_url)
+        index = self._include_index.get(base_url)
+        if index is None: 
+            index = self._include_index.setdefault(base_url, {})
+
+        includes = [] 
+        for link in self.get_transcluder_links(document): 
+            href = link.get("href", None)
+            resolved = index.get(href)
+            if resolved is None: 
+                source_url = self.expand_href(href, document_url)
+                allowed = source_url is not None and self.should_include(source_url)
+                resolved = index[href] = (source_url, allowed)
+            includes.append((link, resolved[0], resolved[1]))
+        return includes
+
     def merge(self, target, subdoc, source_url): 
         """
         replace the link 'target' with the element or elements in 
@@ -181,27 +264,169 @@ class Transcluder:
         # XXX additional merging behavior ? 
         fragment = urlparse.urlparse(source_url)[5]
 
+        if self.splice: 
+            placeholder_id = self._get_placeholder_id(subdoc, fragment)
+            if placeholder_id is not None: 
+                lxmlutils.replace_element(target, etree.Comment(placeholder_id))
+                return
+
         if len(fragment) > 0:                 
-            els = self.xpath(subdoc, "//*[@id='%s']" % fragment)
+            el = self.find_by_id(subdoc, fragment)
 
-            if els is None or len(els) == 0: 
+            if el is None: 
                 self.attach_warning(target, 
                                     'no element with id %s found in %s' % 
                                     (fragment, source_url))
                 return
 
-            el = copy.deepcopy(els[0]) 
+            el = copy.deepcopy(el) 
             lxmlutils.replace_element(target, el)
         else:
-            els = copy.deepcopy(self.xpath(subdoc, '//body/child::node()'))
+            els = copy.deepcopy(_xpaths.body_children(subdoc))
             lxmlutils.replace_many(target, els)
 
+    def find_by_id(self, subdoc, id): 
+        """
+        returns the first element in subdoc with the id given, 
+        looking into the content spliced into it if necessary, 
+        or None if there is none. 
+        """
+        els = _xpaths.element_by_id(subdoc, id=id)
+        if els: 
+            return els[0]
+        return self._find_spliced_by_id(subdoc, id)
+
+    def _find_spliced_by_id(self, node, id): 
+        for placeholder in _xpaths.placeholders(node, prefix=self._placeholder_prefix): 
+            source = self._get_fragment_source(placeholder.text)
+            if source is None: 
+                continue
+            if source.get('id') == id and source.tag != 'body': 
+                return source
+            els = _xpaths.descendant_by_id(source, id=id)
+            if els: 
+                return els[0]
+            el = self._find_spliced_by_id(source, id)
+            if el is not None: 
+                return el
+        return None
+
+    def _get_placeholder_id(self, subdoc, fragment): 
+        """
+        returns the text of the placeholder comment standing for 
+        the part of subdoc selected by fragment, serializing it 
+        the first time it is asked for.  returns None if there 
+        is nothing to include. 
+        """
+        key = (subdoc, fragment)
+        if key in self._placeholder_ids: 
+            return self._placeholder_ids[key]
+
+        source = None
+        html = None
+        if len(fragment) > 0: 
+            source = self.find_by_id(subdoc, fragment)
+            if source is not None: 
+                html = etree.tostring(source, method='html', encoding='utf-8', 
+                                      with_tail=False)
+        else: 
+            bodies = _xpaths.body(subdoc)
+            if bodies: 
+                source = bodies[0]
+                html = lxmlutils.inner_html(source)
+
+        placeholder_id = None
+        if html: 
+            placeholder_id = self._add_fragment(self.expand_placeholders(html), source)
+        self._placeholder_ids[key] = placeholder_id
+        return placeholder_id
+
+    def _add_fragment(self, html, source): 
+        placeholder_id = '%s%d' % (self._placeholder_prefix, len(self._fragments))
+        self._fragments[placeholder_id] = html
+        self._fragment_sources[placeholder_id] = source
+        return placeholder_id
+
+    def _get_fragment_source(self, placeholder_id): 
+        """
+        returns the element whose serialization the placeholder 
+        given stands for, or None if it is not a placeholder
+        """
+        if placeholder_id not in self._fragments: 
+            return None
+        source = self._fragment_sources.get(placeholder_id)
+        if source is None: 
+            # content from the rendered cache is only parsed 
+            # again if something needs to look inside it 
+            parser = etree.HTMLParser(encoding='utf-8')
+            doc = etree.HTML('<html><body>%s</body></html>' % self._fragments[placeholder_id], 
+                             parser)
+            source = self._fragment_sources[placeholder_id] = _xpaths.body(doc)[0]
+        return source
+
+    def _rendered_key(self, source_url, depth): 
+        """
+        returns the key under which the html included for a 
+        link to source_url at the depth given is kept in the 
+        rendered cache, or None if it should not be cached
+        """
+        if not self.splice or self.rendered_cache is None or self.digest is None: 
+            return None
+
+        # the page may have been transcluded at a shallower depth 
+        # earlier in this request, so the digest covers as many 
+        # levels as any transclusion of it could reach 
+        base_url = self.base_url(source_url)
+        digest = self.digest(base_url, self.max_depth)
+        if digest is None: 
+            return None
+
+        fragment = urlparse.urlparse(source_url)[5]
+        return (base_url, fragment, depth, self.max_depth, digest, 
+                tuple(sorted(self.variables.items())))
+
+    def _merge_rendered(self, target, key): 
+        """
+        replaces the link 'target' with a placeholder for the html 
+        kept under key in the rendered cache.  returns False if 
+        there is none. 
+        """
+        placeholder_id = self._placeholder_ids.get(key)
+        if placeholder_id is None: 
+            html = self.rendered_cache.get(key)
+            if html is None: 
+                return False
+            placeholder_id = self._placeholder_ids[key] = self._add_fragment(html, None)
+        lxmlutils.replace_element(target, etree.Comment(placeholder_id))
+        return True
+
+    def _remember_rendered(self, key, subdoc, source_url): 
+        fragment = urlparse.urlparse(source_url)[5]
+        placeholder_id = self._placeholder_ids.get((subdoc, fragment))
+        if placeholder_id is None: 
+            return
+        self._placeholder_ids[key] = placeholder_id
+        html = self._fragments[placeholder_id]
+        self.rendered_cache.put(key, html, len(html))
+
+    def expand_placeholders(self, html): 
+        """
+        returns the html given with the placeholders left by 
+        merge replaced by the content they stand for 
+        """
+        if not self._fragments: 
+            return html
+        return self._placeholder_pat.sub(
+            lambda match: self._fragments.get(match.group(1), match.group(0)), html)
+
     def get_transcluder_links(self, document):
         """
         find all link tags in a document which are
         relevant to transcluder (ie with rel=include)
         """
-        return self.xpath(document, "//a[@rel='include']")
+        if isinstance(document, lxmlutils.UnparsedDocument):
+            return []
+        return _xpaths.include_links(document)
 
     def get_include_url(self, target, document_url): 
         """
@@ -213,8 +438,13 @@ class Transcluder:
         document_url: the url of the document containing the link 
         self.variables: a dictionary used for uri template expansion 
         """
-        source_url = target.get("href", None)
+        return self.expand_href(target.get("href", None), document_url)
 
+    def expand_href(self, source_url, document_url): 
+        """
+        expand and absolutize the href 'source_url' of a link in the 
+        document at document_url as described in get_include_url
+        """
         if source_url is None or len(source_url) == 0: 
             return None
 